@@ -1,13 +1,18 @@
+import json
 import os
+import re
+import time
 from typing import Annotated
 
 from dotenv import load_dotenv
 from fastapi import Depends
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session, sessionmaker
 
+from models.arr import Base as arr_base
 from models.media import Base as media_base
 from models.webSettings import Base as web_base
+from models.workers import Base as workers_base
 
 # region Configuration and Setup
 
@@ -20,17 +25,241 @@ DATABASE_URL_PROGRAM = "sqlite:///data/database.db"
 # Ensure the directory exists
 os.makedirs(os.path.dirname(os.path.abspath("data/database.db")), exist_ok=True)
 
+# Milliseconds a connection waits for the write lock of another process before failing
+SQLITE_BUSY_TIMEOUT = 30000
+# Bytes of the database file read through a memory map instead of read() calls
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
 # Create engines for user and program data
 program_data_engine = create_engine(DATABASE_URL_PROGRAM)
 
+
+@event.listens_for(program_data_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the API read while a worker process writes, with NORMAL a commit only
+    # syncs on checkpoints which is still safe against corruption in WAL mode
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
 # Create tables if they do not exist
 media_base.metadata.create_all(program_data_engine)
+arr_base.metadata.create_all(program_data_engine)
 web_base.metadata.create_all(program_data_engine)
+workers_base.metadata.create_all(program_data_engine)
 
 # Create session makers for user and program data
 ProgramSessionLocal = sessionmaker(
     autocommit=False, autoflush=True, bind=program_data_engine
 )
+# Session per thread for objects used from several threads, like the media server interacter.
+# Call ProgramScopedSession.remove() when a thread is done to end its transaction.
+ProgramScopedSession = scoped_session(ProgramSessionLocal)
+
+# endregion
+
+
+# region Migrations
+# Media tables with the link table of their users
+MEDIA_TABLES = (
+    ("favoriteMovies", "favoriteMovieUsers"),
+    ("favoriteSeries", "favoriteSeriesUsers"),
+    ("onResumeMovies", "onResumeMovieUsers"),
+    ("onResumeSeries", "onResumeSeriesUsers"),
+    ("PlayedMovies", "PlayedMovieUsers"),
+    ("PlayedSeries", "PlayedSeriesUsers"),
+    ("PlayedEpisodes", "PlayedEpisodeUsers"),
+)
+
+
+def _get_columns(connection, table):
+    return {
+        row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info("{table}")')
+    }
+
+
+def _migrate_played_episode_columns(connection):
+    """Splits the episode mediaId into columns and moves the JSON userIds into PlayedEpisodeUsers."""
+    columns = _get_columns(connection, "PlayedEpisodes")
+    for column, column_type in (
+        ("seriesId", "VARCHAR"),
+        ("seasonNumber", "INTEGER"),
+        ("episodeNumber", "INTEGER"),
+    ):
+        if column not in columns:
+            connection.exec_driver_sql(
+                f'ALTER TABLE "PlayedEpisodes" ADD COLUMN {column} {column_type}'
+            )
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS "ix_PlayedEpisodes_series_position" '
+        'ON "PlayedEpisodes" (seriesId, seasonNumber, episodeNumber)'
+    )
+
+    episode_updates = []
+    for row_id, media_id in connection.exec_driver_sql(
+        'SELECT id, mediaId FROM "PlayedEpisodes" WHERE seriesId IS NULL'
+    ):
+        match = re.fullmatch(r"(.+)S(\d+)E(\d+)", str(media_id))
+        if match:
+            episode_updates.append(
+                {
+                    "id": row_id,
+                    "seriesId": match.group(1),
+                    "seasonNumber": int(match.group(2)),
+                    "episodeNumber": int(match.group(3)),
+                }
+            )
+    if episode_updates:
+        connection.execute(
+            text(
+                'UPDATE "PlayedEpisodes" SET seriesId = :seriesId, seasonNumber = :seasonNumber, '
+                "episodeNumber = :episodeNumber WHERE id = :id"
+            ),
+            episode_updates,
+        )
+
+    _copy_user_ids(connection, "PlayedEpisodes", "PlayedEpisodeUsers")
+
+
+def _copy_user_ids(connection, table, link_table):
+    """Copies the JSON userIds column of an existing table into its link table."""
+    # Tables created after the link tables were added have no userIds column
+    if "userIds" not in _get_columns(connection, table):
+        return
+
+    user_links = []
+    for row_id, user_ids in connection.exec_driver_sql(
+        f'SELECT id, userIds FROM "{table}"'
+    ):
+        for user_id in json.loads(user_ids) if user_ids else []:
+            user_links.append({"itemId": row_id, "userId": user_id})
+    if user_links:
+        connection.execute(
+            text(
+                f'INSERT OR IGNORE INTO "{link_table}" (itemId, userId) VALUES (:itemId, :userId)'
+            ),
+            user_links,
+        )
+
+
+def _migrate_user_link_tables(connection):
+    """Moves the JSON userIds of the other media tables into their link tables."""
+    for table, link_table in MEDIA_TABLES:
+        if table != "PlayedEpisodes":
+            _copy_user_ids(connection, table, link_table)
+
+
+def _migrate_lookup_indexes(connection):
+    """
+    Adds a unique mediaId index to the media tables and the lookup indexes of the caches.
+    Duplicate media rows are merged into the oldest one first, keeping all their users.
+    """
+    for table, link_table in MEDIA_TABLES:
+        keep_ids = f'SELECT MIN(id) FROM "{table}" GROUP BY mediaId'
+        connection.exec_driver_sql(
+            f'INSERT OR IGNORE INTO "{link_table}" (itemId, userId) '
+            f'SELECT keep.id, link.userId FROM "{link_table}" link '
+            f'JOIN "{table}" item ON item.id = link.itemId '
+            f'JOIN (SELECT mediaId, MIN(id) AS id FROM "{table}" GROUP BY mediaId) keep '
+            "ON keep.mediaId = item.mediaId WHERE item.id != keep.id"
+        )
+        connection.exec_driver_sql(
+            f'DELETE FROM "{link_table}" WHERE itemId NOT IN ({keep_ids})'
+        )
+        connection.exec_driver_sql(
+            f'DELETE FROM "{table}" WHERE id NOT IN ({keep_ids})'
+        )
+        connection.exec_driver_sql(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "ux_{table}_mediaId" ON "{table}" (mediaId)'
+        )
+
+    # Only the latest cursor of a user counts, an older duplicate just causes a full resync
+    connection.exec_driver_sql(
+        'DELETE FROM "mediaServerSyncCursors" WHERE id NOT IN '
+        '(SELECT MAX(id) FROM "mediaServerSyncCursors" GROUP BY userId, syncType)'
+    )
+    connection.exec_driver_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ux_mediaServerSyncCursors_user" '
+        'ON "mediaServerSyncCursors" (userId, syncType)'
+    )
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS "ix_musicVideoCache_lookup" '
+        'ON "musicVideoCache" (title, artists, album)'
+    )
+
+
+def _migrate_provider_ids(connection):
+    """
+    Adds the providerIds column to the media tables that store it and stores the episode
+    positions of PlayedEpisodes as integers, older rows can hold them as strings.
+    """
+    for table in (
+        "favoriteMovies",
+        "favoriteSeries",
+        "onResumeMovies",
+        "PlayedMovies",
+        "PlayedSeries",
+    ):
+        if "providerIds" not in _get_columns(connection, table):
+            connection.exec_driver_sql(
+                f'ALTER TABLE "{table}" ADD COLUMN providerIds VARCHAR'
+            )
+
+    # Strings sort after all integers, the furthest played episode is found by the integers
+    for column in ("seasonNumber", "episodeNumber"):
+        connection.exec_driver_sql(
+            f'UPDATE "PlayedEpisodes" SET {column} = CAST({column} AS INTEGER) '
+            f"WHERE {column} IS NOT NULL AND typeof({column}) != 'integer'"
+        )
+
+
+# Schema changes create_all can not make to existing tables, applied once in order.
+# Migrations also run on new databases, so they have to check what already exists.
+MIGRATIONS = [
+    (1, "played_episode_columns", _migrate_played_episode_columns),
+    (2, "user_link_tables", _migrate_user_link_tables),
+    (3, "lookup_indexes", _migrate_lookup_indexes),
+    (4, "provider_ids", _migrate_provider_ids),
+]
+
+
+def run_migrations(engine):
+    """
+    Applies the pending migrations in one transaction, called once at startup.
+    BEGIN IMMEDIATE takes the write lock before the applied versions are read,
+    so a second process waits for it and then finds the migrations applied.
+    """
+    with engine.connect() as connection:
+        # pysqlite does not begin a transaction for DDL and SELECT statements itself
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        connection.exec_driver_sql(
+            'CREATE TABLE IF NOT EXISTS "schemaMigrations" '
+            "(version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, appliedAt INTEGER NOT NULL)"
+        )
+        applied = {
+            row[0]
+            for row in connection.exec_driver_sql(
+                'SELECT version FROM "schemaMigrations"'
+            )
+        }
+
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            migrate(connection)
+            connection.execute(
+                text(
+                    'INSERT INTO "schemaMigrations" (version, name, appliedAt) '
+                    "VALUES (:version, :name, :applied_at)"
+                ),
+                {"version": version, "name": name, "applied_at": int(time.time())},
+            )
+        connection.commit()
+
 
 # endregion
 
@@ -1,24 +1,37 @@
 import logging
 import os
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import FileResponse
 
+from database.database import program_data_engine, run_migrations
 from routers import mediaserver
 from routers import music_videos
 from routers import radarr
 from routers import sonarr
 from routers import spotify
 from routers import system
+from routers import webhooks
 from utils.log_manager import LoggingManager
+import workers.workers as workers
 from workers.workers import WorkerManager
 
 logging_manager = LoggingManager()
 logging_manager.log("Program is starting", level=logging.INFO)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Releases the worker leases, so other replicas take over without waiting for them to expire
+    if workers.running_manager is not None:
+        workers.running_manager.stop_workers()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(radarr.router, prefix="/api")
 app.include_router(sonarr.router, prefix="/api")
@@ -26,6 +39,7 @@ app.include_router(spotify.router, prefix="/api")
 app.include_router(music_videos.router, prefix="/api")
 app.include_router(mediaserver.router, prefix="/api")
 app.include_router(system.router, prefix="/api")
+app.include_router(webhooks.router, prefix="/api")
 
 os.makedirs("./static/assets", exist_ok=True)  # Fix if using empty pull
 app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
@@ -39,6 +53,8 @@ async def read_index():
 
 
 def main_start():
+    # Before the workers start, their processes expect the migrated schema
+    run_migrations(program_data_engine)
     manager = WorkerManager("./workers/config.yml")
     manager.start_workers()
 
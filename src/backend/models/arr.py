@@ -0,0 +1,65 @@
+import json
+
+from sqlalchemy import Column, Index, Integer, String, VARCHAR, TypeDecorator
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+
+class JSONEncodedDict(TypeDecorator):
+    """Enables JSON storage by encoding and decoding on the fly."""
+
+    impl = VARCHAR
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            if isinstance(value, str):
+                return value
+
+            value = json.dumps(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = json.loads(value)
+        return value
+
+
+class ArrItems(Base):
+    """Local mirror of the movies of Radarr and the series of Sonarr."""
+
+    __tablename__ = "arrItems"
+
+    id = Column(Integer, primary_key=True)
+    # radarr or sonarr
+    arrType = Column(String, nullable=False)
+    arrId = Column(Integer, nullable=False)
+    # The item as returned by the arr API, None until a stale placeholder is fetched
+    data = Column(JSONEncodedDict)
+    # Set when the item changed in the arr, it is fetched again on the next refresh
+    stale = Column(Integer, nullable=False, default=0)
+    updated = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ux_arrItems_item", "arrType", "arrId", unique=True),)
+
+
+class ArrMirrorState(Base):
+    __tablename__ = "arrMirrorState"
+
+    arrType = Column(String, primary_key=True)
+    # Epoch seconds up to which the arr history has been applied
+    historyCursor = Column(Integer, nullable=False)
+    lastFullSync = Column(Integer, nullable=False)
+
+
+class SonarrEpisodes(Base):
+    """Episodes of a Sonarr series, kept until the series changes."""
+
+    __tablename__ = "sonarrEpisodes"
+
+    seriesId = Column(Integer, primary_key=True)
+    # Fingerprint of the series the episodes were fetched with, see series_fingerprint
+    fingerprint = Column(String, nullable=False)
+    episodes = Column(JSONEncodedDict, nullable=False)
+    updated = Column(Integer, nullable=False)
@@ -1,6 +1,14 @@
 import json
 
-from sqlalchemy import Column, Integer, String, VARCHAR, TypeDecorator
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    VARCHAR,
+    TypeDecorator,
+)
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -32,10 +40,24 @@ class FavoriteMovies(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     mediaId = Column(Integer, nullable=False)
+    # TMDB/TVDB/IMDB ids of the item, e.g. {"Tmdb": "603"}
+    providerIds = Column(JSONEncodedDict)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ux_favoriteMovies_mediaId", "mediaId", unique=True),)
+
+
+class FavoriteMovieUsers(Base):
+    __tablename__ = "favoriteMovieUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("favoriteMovies.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_favoriteMovieUsers_userId", "userId", "itemId"),)
+
 
 class FavoriteSeries(Base):
     __tablename__ = "favoriteSeries"
@@ -43,10 +65,23 @@ class FavoriteSeries(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     mediaId = Column(Integer, nullable=False)
+    providerIds = Column(JSONEncodedDict)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ux_favoriteSeries_mediaId", "mediaId", unique=True),)
+
+
+class FavoriteSeriesUsers(Base):
+    __tablename__ = "favoriteSeriesUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("favoriteSeries.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_favoriteSeriesUsers_userId", "userId", "itemId"),)
+
 
 class OnResumeMovies(Base):
     __tablename__ = "onResumeMovies"
@@ -54,10 +89,23 @@ class OnResumeMovies(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     mediaId = Column(Integer, nullable=False)
+    providerIds = Column(JSONEncodedDict)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ux_onResumeMovies_mediaId", "mediaId", unique=True),)
+
+
+class OnResumeMovieUsers(Base):
+    __tablename__ = "onResumeMovieUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("onResumeMovies.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_onResumeMovieUsers_userId", "userId", "itemId"),)
+
 
 class OnResumeSeries(Base):
     __tablename__ = "onResumeSeries"
@@ -66,9 +114,21 @@ class OnResumeSeries(Base):
     name = Column(String, nullable=False)
     mediaId = Column(Integer, nullable=False)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ux_onResumeSeries_mediaId", "mediaId", unique=True),)
+
+
+class OnResumeSeriesUsers(Base):
+    __tablename__ = "onResumeSeriesUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("onResumeSeries.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_onResumeSeriesUsers_userId", "userId", "itemId"),)
+
 
 class PlayedMovies(Base):
     __tablename__ = "PlayedMovies"
@@ -76,10 +136,23 @@ class PlayedMovies(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     mediaId = Column(Integer, nullable=False)
+    providerIds = Column(JSONEncodedDict)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ux_PlayedMovies_mediaId", "mediaId", unique=True),)
+
+
+class PlayedMovieUsers(Base):
+    __tablename__ = "PlayedMovieUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("PlayedMovies.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_PlayedMovieUsers_userId", "userId", "itemId"),)
+
 
 class PlayedSeries(Base):
     __tablename__ = "PlayedSeries"
@@ -87,21 +160,83 @@ class PlayedSeries(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     mediaId = Column(Integer, nullable=False)
+    providerIds = Column(JSONEncodedDict)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (Index("ux_PlayedSeries_mediaId", "mediaId", unique=True),)
+
+
+class PlayedSeriesUsers(Base):
+    __tablename__ = "PlayedSeriesUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("PlayedSeries.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_PlayedSeriesUsers_userId", "userId", "itemId"),)
+
 
 class PlayedEpisodes(Base):
     __tablename__ = "PlayedEpisodes"
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
+    # "{seriesId}S{seasonNumber}E{episodeNumber}"
     mediaId = Column(String, nullable=False)
+    # Media server ids are GUID strings on Jellyfin, so the series id stays a string
+    seriesId = Column(String)
+    seasonNumber = Column(Integer)
+    episodeNumber = Column(Integer)
 
-    userIds = Column(JSONEncodedDict)
     date = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        Index("ux_PlayedEpisodes_mediaId", "mediaId", unique=True),
+        Index(
+            "ix_PlayedEpisodes_series_position",
+            "seriesId",
+            "seasonNumber",
+            "episodeNumber",
+        ),
+    )
+
+
+class PlayedEpisodeUsers(Base):
+    __tablename__ = "PlayedEpisodeUsers"
+
+    itemId = Column(
+        Integer, ForeignKey("PlayedEpisodes.id", ondelete="CASCADE"), primary_key=True
+    )
+    userId = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_PlayedEpisodeUsers_userId", "userId", "itemId"),)
+
+
+class MediaServerSnapshots(Base):
+    __tablename__ = "mediaServerSnapshots"
+
+    # The id is the snapshot version
+    id = Column(Integer, primary_key=True)
+    date = Column(Integer, nullable=False)
+
+
+class MediaServerSyncCursors(Base):
+    __tablename__ = "mediaServerSyncCursors"
+
+    id = Column(Integer, primary_key=True)
+    userId = Column(String, nullable=False)
+    # The synced user data, "played" or "favorites"
+    syncType = Column(String, nullable=False)
+    # Timestamp the next incremental sync fetches changes from
+    cursor = Column(Integer, nullable=False)
+    lastFullSync = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ux_mediaServerSyncCursors_user", "userId", "syncType", unique=True),
+    )
+
 
 class musicVideoCache(Base):
     __tablename__ = "musicVideoCache"
@@ -114,3 +249,6 @@ class musicVideoCache(Base):
     album = Column(String)
     dateAdded = Column(Integer, nullable=False)
     additionalInfo = Column(JSONEncodedDict)
+
+    # Cache lookups filter on title, artists and album together
+    __table_args__ = (Index("ix_musicVideoCache_lookup", "title", "artists", "album"),)
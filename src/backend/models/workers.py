@@ -0,0 +1,68 @@
+import json
+
+from sqlalchemy import Column, Float, Integer, String, VARCHAR, TypeDecorator
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+
+class JSONEncodedDict(TypeDecorator):
+    """Enables JSON storage by encoding and decoding on the fly."""
+
+    impl = VARCHAR
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            if isinstance(value, str):
+                return value
+
+            value = json.dumps(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = json.loads(value)
+        return value
+
+
+class WorkerRuns(Base):
+    __tablename__ = "worker_runs"
+
+    id = Column(Integer, primary_key=True)
+    worker = Column(String, nullable=False, index=True)
+    startTime = Column(Float, nullable=False, index=True)
+    endTime = Column(Float)
+    # running, success, failed or killed
+    outcome = Column(String, nullable=False, default="running")
+    # Seconds spent in each phase of the run, e.g. {"fetch_arr_items": 1.2}
+    phases = Column(JSONEncodedDict)
+
+
+class WorkerLeases(Base):
+    __tablename__ = "workerLeases"
+
+    worker = Column(String, primary_key=True)
+    owner = Column(String)
+    # Fencing token, increases every time another run takes the lease
+    token = Column(Integer, nullable=False, default=0)
+    expires = Column(Float, nullable=False, default=0)
+
+
+class WorkerState(Base):
+    """State a worker keeps between runs, like search cooldowns, every run is a new process."""
+
+    __tablename__ = "workerState"
+
+    key = Column(String, primary_key=True)
+    value = Column(JSONEncodedDict, nullable=False)
+
+
+class ForwardedRuns(Base):
+    """Triggered runs received by a replica that does not hold the lease of the worker."""
+
+    __tablename__ = "forwardedRuns"
+
+    id = Column(Integer, primary_key=True)
+    worker = Column(String, nullable=False, index=True)
+    kwargs = Column(JSONEncodedDict, nullable=False)
@@ -4,9 +4,10 @@ from fastapi import APIRouter
 from pyarr import RadarrAPI
 
 import schemas.settings as settings
+from utils.arr_mirror import ArrMirror
 from utils.config_manager import ConfigManager
 from utils.customSonarApi import customSonarAPI
-from utils.general_arr_actions import link_arr_to_media_server
+from utils.general_arr_actions import ArrMatcher
 from utils.log_manager import LoggingManager
 from utils.media_server_interaction import MediaServerinteracter
 
@@ -27,6 +28,7 @@ def get_info():
         config.MEDIASERVER.media_server_type,
         config.MEDIASERVER.media_server_base_url,
         config.MEDIASERVER.media_server_api_key,
+        config.MEDIASERVER.max_concurrent_requests,
     )
     users = media_server.get_users()
 
@@ -42,11 +44,12 @@ def get_media_info():
         config.MEDIASERVER.media_server_type,
         config.MEDIASERVER.media_server_base_url,
         config.MEDIASERVER.media_server_api_key,
+        config.MEDIASERVER.max_concurrent_requests,
     )
     sonarr = customSonarAPI(config.SONARR.base_url, config.SONARR.api_key)
     radarr = RadarrAPI(config.RADARR.base_url, config.RADARR.api_key)
-    series = sonarr.get_series()
-    movies = radarr.get_movie()
+    series_matcher = ArrMatcher(ArrMirror("sonarr", sonarr).get_items())
+    movie_matcher = ArrMatcher(ArrMirror("radarr", radarr).get_items())
 
     favorites = media_server.get_all_favorites()
     played = media_server.get_played()
@@ -55,28 +58,28 @@ def get_media_info():
         set(
             arr_item["id"]
             for item in favorites["Series"]
-            if (arr_item := link_arr_to_media_server(item, series)) is not None
+            if (arr_item := series_matcher.match(item)) is not None
         )
     )
     played_sonarr = list(
         set(
             arr_item["id"]
             for item in played["Series"]
-            if (arr_item := link_arr_to_media_server(item, series)) is not None
+            if (arr_item := series_matcher.match(item)) is not None
         )
     )
     favorited_radarr = list(
         set(
             arr_item["id"]
             for item in favorites["Movies"]
-            if (arr_item := link_arr_to_media_server(item, movies)) is not None
+            if (arr_item := movie_matcher.match(item)) is not None
         )
     )
     played_radarr = list(
         set(
             arr_item["id"]
             for item in played["Movies"]
-            if (arr_item := link_arr_to_media_server(item, movies)) is not None
+            if (arr_item := movie_matcher.match(item)) is not None
         )
     )
 
@@ -111,6 +114,7 @@ def get_playlists():
         config.MEDIASERVER.media_server_type,
         config.MEDIASERVER.media_server_base_url,
         config.MEDIASERVER.media_server_api_key,
+        config.MEDIASERVER.max_concurrent_requests,
     )
 
     return media_server.get_playlist_items()
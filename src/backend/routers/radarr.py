@@ -5,6 +5,7 @@ from fastapi.responses import JSONResponse
 from pyarr import RadarrAPI
 
 import schemas.settings as settings
+from utils.arr_mirror import ArrMirror
 from utils.config_manager import ConfigManager
 from utils.log_manager import LoggingManager
 from workers.radarr import delete_unmonitored_files
@@ -40,7 +41,7 @@ def get_info():
 def get_items():
     config = config_manager.get_config()
     radarr = RadarrAPI(config.RADARR.base_url, config.RADARR.api_key)
-    return radarr.get_movie()
+    return ArrMirror("radarr", radarr).get_items()
 
 
 @router.post("/item", description="Edit an item")
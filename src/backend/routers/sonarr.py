@@ -5,6 +5,7 @@ from fastapi.responses import JSONResponse
 from pyarr import SonarrAPI
 
 import schemas.settings as settings
+from utils.arr_mirror import ArrMirror
 from utils.config_manager import ConfigManager
 from utils.customSonarApi import customSonarAPI
 from utils.log_manager import LoggingManager
@@ -41,7 +42,7 @@ def get_info():
 def get_items():
     config = config_manager.get_config()
     sonarr = SonarrAPI(config.SONARR.base_url, config.SONARR.api_key)
-    return sonarr.get_series()
+    return ArrMirror("sonarr", sonarr).get_items()
 
 
 @router.post("/item", description="Edit an item")
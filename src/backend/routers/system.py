@@ -1,14 +1,15 @@
 import json
-from typing import Annotated
+from typing import Annotated, Optional
 
 from fastapi import APIRouter
-from fastapi import Form
+from fastapi import Form, Query
 from fastapi.responses import JSONResponse
 
 import schemas.settings as settings
 from database.database import program_db_dependency
 from models.webSettings import SwipeArrSeenRadarr, SwipeArrSeenSonarr
 from utils.config_manager import ConfigManager
+from utils.run_history import get_run_statistics
 
 # region Configuration and Setup
 router = APIRouter(prefix="/system", tags=["system"])
@@ -82,3 +83,14 @@ async def clear_seen_items(db: program_db_dependency):
     db.delete(SwipeArrSeenSonarr)
     db.delete(SwipeArrSeenRadarr)
     db.commit()
+
+
+@router.get(
+    "/worker-runs",
+    description="Get duration percentiles of the latest worker runs and their phases",
+)
+def get_worker_runs(
+    worker: Optional[str] = Query(None, description="Only return this worker"),
+    limit: int = Query(500, description="Amount of latest runs per worker to use"),
+):
+    return get_run_statistics(worker=worker, limit=limit)
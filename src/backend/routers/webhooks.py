@@ -0,0 +1,112 @@
+import logging
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+import workers.workers as workers
+from utils.arr_mirror import invalidate_arr_items
+from utils.log_manager import LoggingManager
+
+# region Configuration and Setup
+router = APIRouter(prefix="/webhooks", tags=["Webhooks"])
+logging_manager = LoggingManager()
+
+SONARR_EVENTS = {"Download", "SeriesAdd"}
+RADARR_EVENTS = {"Download", "MovieAdded"}
+# Jellyfin webhook plugin notification types and Emby webhook events
+MEDIA_SERVER_EVENTS = {
+    "PlaybackStop",
+    "UserDataSaved",
+    "playback.stop",
+    "item.rate",
+    "item.markplayed",
+    "item.markunplayed",
+}
+
+
+# endregion
+
+
+def _queue_event(worker_name: str, **targets) -> JSONResponse:
+    if workers.running_manager is None:
+        return JSONResponse({"message": "Workers are not running"}, status_code=503)
+
+    logging_manager.log(f"Queueing {worker_name} for {targets}", level=logging.DEBUG)
+    workers.running_manager.queue_event(worker_name, **targets)
+    return JSONResponse({"message": "Queued"}, status_code=202)
+
+
+@router.post(
+    "/sonarr",
+    description="Receive Sonarr events, Download and SeriesAdd re-evaluate the series",
+)
+def sonarr_webhook(payload: dict):
+    series_id = (payload.get("series") or {}).get("id")
+    # Every event with a series means the mirrored copy of it is outdated
+    if series_id is not None:
+        invalidate_arr_items("sonarr", [series_id])
+    if payload.get("eventType") not in SONARR_EVENTS or series_id is None:
+        return JSONResponse({"message": "Ignored"})
+
+    return _queue_event("workers.sonarr", series_ids=[series_id])
+
+
+@router.post(
+    "/radarr",
+    description="Receive Radarr events, Download and MovieAdded re-evaluate the movie",
+)
+def radarr_webhook(payload: dict):
+    movie_id = (payload.get("movie") or {}).get("id")
+    # Every event with a movie means the mirrored copy of it is outdated
+    if movie_id is not None:
+        invalidate_arr_items("radarr", [movie_id])
+    if payload.get("eventType") not in RADARR_EVENTS or movie_id is None:
+        return JSONResponse({"message": "Ignored"})
+
+    return _queue_event("workers.radarr", movie_ids=[movie_id])
+
+
+def _get_provider_ids(item: dict) -> dict:
+    """Emby nests the provider IDs, the Jellyfin webhook plugin flattens them to Provider_<name>."""
+    provider_ids = item.get("ProviderIds")
+    if not isinstance(provider_ids, dict):
+        provider_ids = {
+            key[len("Provider_") :]: value
+            for key, value in item.items()
+            if key.startswith("Provider_")
+        }
+    return {provider: value for provider, value in provider_ids.items() if value}
+
+
+@router.post(
+    "/mediaserver",
+    description="Receive Emby/Jellyfin playback stop, user data and favorite events",
+)
+def media_server_webhook(payload: dict):
+    # Jellyfin sends flat notifications, Emby nests the item and user
+    event = payload.get("NotificationType") or payload.get("Event")
+    if event not in MEDIA_SERVER_EVENTS:
+        return JSONResponse({"message": "Ignored"})
+
+    item = payload.get("Item") or payload
+    item_type = item.get("Type") or item.get("ItemType")
+    if item_type in ("Movie", "Series"):
+        worker_name = "workers.radarr" if item_type == "Movie" else "workers.sonarr"
+        media_server_item = {
+            "Name": item.get("Name"),
+            "ProviderIds": _get_provider_ids(item),
+        }
+    elif item_type == "Episode":
+        # The provider IDs of an episode are not the ones of its series
+        worker_name = "workers.sonarr"
+        media_server_item = {"Name": item.get("SeriesName"), "ProviderIds": {}}
+    else:
+        return JSONResponse({"message": "Ignored"})
+    if not media_server_item["Name"]:
+        return JSONResponse({"message": "Ignored"})
+
+    targets = {"media_server_items": [media_server_item]}
+    user_id = (payload.get("User") or {}).get("Id") or payload.get("UserId")
+    if user_id:
+        targets["media_server_user_ids"] = [user_id]
+    return _queue_event(worker_name, **targets)
@@ -78,6 +78,10 @@ class SonarrSettings(BaseModel):
     delete_unmonitored_files: bool = False
     exclude_tags_from_deletion: list = []
 
+    # Episode lists fetched from Sonarr at the same time and seconds to wait for each
+    max_concurrent_requests: int = 4
+    request_timeout: int = 30
+
     popular_filters: dict = {
         "very_popular": [],
         "popular": [],
@@ -186,6 +190,8 @@ class MediaServerSettings(BaseModel):
     media_server_base_url: str = "http://media_server:8096/"
     media_server_api_key: str = "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
     create_leaving_soon_collections: bool = False
+    # Users fetched from the media server at the same time
+    max_concurrent_requests: int = 4
 
 
 class MiscSettings(BaseModel):
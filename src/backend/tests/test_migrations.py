@@ -0,0 +1,83 @@
+import importlib
+
+import pytest
+from sqlalchemy import create_engine
+
+# Indexes the migrations create on databases from before the models declared them
+MIGRATION_INDEXES = [
+    "ix_PlayedEpisodes_series_position",
+    "ux_mediaServerSyncCursors_user",
+    "ix_musicVideoCache_lookup",
+]
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # The module creates its database in the working directory when it is imported
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module("database.database")
+
+
+@pytest.fixture
+def migrated_connection(tmp_path, database):
+    """A database with the indexes of the migrations dropped, like an old one, then migrated."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrated.db'}")
+    for base in (
+        database.media_base,
+        database.arr_base,
+        database.web_base,
+        database.workers_base,
+    ):
+        base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        indexes = MIGRATION_INDEXES + [
+            f"ux_{table}_mediaId" for table, _ in database.MEDIA_TABLES
+        ]
+        for index in indexes:
+            connection.exec_driver_sql(f'DROP INDEX "{index}"')
+
+    database.run_migrations(engine)
+    with engine.connect() as connection:
+        yield connection
+    engine.dispose()
+
+
+def _query_plan(connection, query):
+    return " ".join(
+        row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {query}")
+    )
+
+
+def test_media_lookups_use_indexes(database, migrated_connection):
+    for table, link_table in database.MEDIA_TABLES:
+        plan = _query_plan(
+            migrated_connection,
+            f"SELECT mediaId, id FROM \"{table}\" WHERE mediaId IN ('1', '2')",
+        )
+        assert f"INDEX ux_{table}_mediaId" in plan, plan
+
+        plan = _query_plan(
+            migrated_connection,
+            f"SELECT itemId FROM \"{link_table}\" WHERE userId = 'user'",
+        )
+        assert f"INDEX ix_{link_table}_userId" in plan, plan
+
+
+def test_cache_lookups_use_indexes(migrated_connection):
+    plan = _query_plan(
+        migrated_connection,
+        "SELECT * FROM \"PlayedEpisodes\" WHERE seriesId = '1' AND seasonNumber = 2",
+    )
+    assert "INDEX ix_PlayedEpisodes_series_position" in plan, plan
+
+    plan = _query_plan(
+        migrated_connection,
+        "SELECT * FROM \"mediaServerSyncCursors\" WHERE userId = 'user' AND syncType = 'played'",
+    )
+    assert "INDEX ux_mediaServerSyncCursors_user" in plan, plan
+
+    plan = _query_plan(
+        migrated_connection,
+        "SELECT * FROM \"musicVideoCache\" WHERE title = 'a' AND artists = 'b' AND album = 'c'",
+    )
+    assert "INDEX ix_musicVideoCache_lookup" in plan, plan
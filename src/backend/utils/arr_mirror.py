@@ -0,0 +1,307 @@
+import datetime
+import hashlib
+import json
+
+from pyarr.exceptions import PyarrResourceNotFound
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+
+from database.database import ProgramSessionLocal
+from models.arr import ArrItems, ArrMirrorState, SonarrEpisodes
+
+# Seconds between full downloads of the library, they pick up the changes the history
+# does not show like deleted items or edits in the arr UI
+ARR_FULL_SYNC_INTERVAL = 60 * 60
+# Seconds the history is read back before the cursor to cover clock differences
+ARR_HISTORY_OVERLAP = 5 * 60
+# With more changed items than this a full download is cheaper than fetching them one by one
+ARR_MAX_INCREMENTAL_ITEMS = 200
+
+# Seconds cached episodes are used at most, a safety net for changes the fingerprint misses
+EPISODE_CACHE_MAX_AGE = 24 * 60 * 60
+
+# History record field holding the ID of the changed item
+HISTORY_ID_FIELDS = {"radarr": "movieId", "sonarr": "seriesId"}
+
+
+def invalidate_arr_items(arr_type, arr_ids):
+    """
+    Marks items as changed so the next refresh fetches them again, for Sonarr the cached
+    episodes of the series are dropped too.
+    Works for items not in the mirror yet, like items just added to the arr.
+
+    Args:
+        arr_type: radarr or sonarr
+        arr_ids: IDs of the items in the arr
+    """
+    arr_ids = set(arr_ids)
+    if not arr_ids:
+        return
+
+    utc_now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    stmt = insert(ArrItems.__table__)
+    with ProgramSessionLocal() as db:
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["arrType", "arrId"], set_={"stale": 1}
+            ),
+            [
+                {"arrType": arr_type, "arrId": arr_id, "stale": 1, "updated": utc_now}
+                for arr_id in arr_ids
+            ],
+        )
+        if arr_type == "sonarr":
+            _delete_episodes(db, arr_ids)
+        db.commit()
+
+
+def _delete_episodes(db, series_ids):
+    series_ids = list(series_ids)
+    for i in range(0, len(series_ids), 500):
+        db.execute(
+            delete(SonarrEpisodes).where(
+                SonarrEpisodes.seriesId.in_(series_ids[i : i + 500])
+            )
+        )
+
+
+def series_fingerprint(series):
+    """
+    Hash of the parts of a Sonarr series that change with its episodes, like the episode
+    and file counts of every season and the air dates.
+    """
+    fingerprint = {
+        key: series.get(key)
+        for key in ("statistics", "seasons", "previousAiring", "nextAiring")
+    }
+    return hashlib.sha1(
+        json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def load_cached_episodes(series_list):
+    """
+    Returns the cached episodes of the series that did not change since they were fetched.
+
+    Args:
+        series_list: The Sonarr series, as returned by the API or the mirror
+
+    Returns:
+        dict: Episodes per series ID, series without valid cache are left out
+    """
+    fingerprints = {series["id"]: series_fingerprint(series) for series in series_list}
+    min_updated = (
+        int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        - EPISODE_CACHE_MAX_AGE
+    )
+    series_ids = list(fingerprints)
+    episodes_by_series = {}
+    with ProgramSessionLocal() as db:
+        for i in range(0, len(series_ids), 500):
+            for series_id, fingerprint, episodes in db.execute(
+                select(
+                    SonarrEpisodes.seriesId,
+                    SonarrEpisodes.fingerprint,
+                    SonarrEpisodes.episodes,
+                )
+                .where(SonarrEpisodes.seriesId.in_(series_ids[i : i + 500]))
+                .where(SonarrEpisodes.updated >= min_updated)
+            ):
+                if fingerprint == fingerprints[series_id]:
+                    episodes_by_series[series_id] = episodes
+    return episodes_by_series
+
+
+def store_episodes(series_list, episodes_by_series):
+    """
+    Caches freshly fetched episodes with the fingerprint of their series.
+
+    Args:
+        series_list: The Sonarr series the episodes were fetched for
+        episodes_by_series: Episodes per series ID
+    """
+    utc_now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    rows = [
+        {
+            "seriesId": series["id"],
+            "fingerprint": series_fingerprint(series),
+            "episodes": episodes_by_series[series["id"]],
+            "updated": utc_now,
+        }
+        for series in series_list
+        if series["id"] in episodes_by_series
+    ]
+    if not rows:
+        return
+
+    stmt = insert(SonarrEpisodes.__table__)
+    with ProgramSessionLocal() as db:
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["seriesId"],
+                set_={
+                    "fingerprint": stmt.excluded.fingerprint,
+                    "episodes": stmt.excluded.episodes,
+                    "updated": stmt.excluded.updated,
+                },
+            ),
+            rows,
+        )
+        db.commit()
+
+
+class ArrMirror:
+    """
+    Local copy of the movies of Radarr or the series of Sonarr.
+    Refreshing only fetches the items the arr history or a webhook reported as changed,
+    with a full download every ARR_FULL_SYNC_INTERVAL seconds.
+    """
+
+    def __init__(self, arr_type, client):
+        """
+        Args:
+            arr_type: radarr or sonarr
+            client: The pyarr RadarrAPI or SonarrAPI of the arr
+        """
+        if arr_type not in HISTORY_ID_FIELDS:
+            raise Exception("Arr type not supported " + arr_type)
+        self.arr_type = arr_type
+        self.client = client
+
+    def _fetch_all(self):
+        if self.arr_type == "radarr":
+            return self.client.get_movie()
+        return self.client.get_series()
+
+    def _fetch_item(self, arr_id):
+        if self.arr_type == "radarr":
+            return self.client.get_movie(arr_id)
+        return self.client.get_series(arr_id)
+
+    def _fetch_changed_ids(self, since):
+        since_date = datetime.datetime.fromtimestamp(
+            since - ARR_HISTORY_OVERLAP, tz=datetime.timezone.utc
+        ).strftime("%Y-%m-%dT%H:%M:%SZ")
+        records = self.client._get(
+            "history/since", self.client.ver_uri, params={"date": since_date}
+        )
+        id_field = HISTORY_ID_FIELDS[self.arr_type]
+        return {record[id_field] for record in records if record.get(id_field)}
+
+    def _store_items(self, db, items, utc_now):
+        if not items:
+            return
+        stmt = insert(ArrItems.__table__)
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["arrType", "arrId"],
+                set_={
+                    "data": stmt.excluded.data,
+                    "stale": 0,
+                    "updated": stmt.excluded.updated,
+                },
+            ),
+            [
+                {
+                    "arrType": self.arr_type,
+                    "arrId": item["id"],
+                    "data": item,
+                    "stale": 0,
+                    "updated": utc_now,
+                }
+                for item in items
+            ],
+        )
+
+    def _delete_items(self, db, arr_ids):
+        arr_ids = list(arr_ids)
+        for i in range(0, len(arr_ids), 500):
+            db.execute(
+                delete(ArrItems)
+                .where(ArrItems.arrType == self.arr_type)
+                .where(ArrItems.arrId.in_(arr_ids[i : i + 500]))
+            )
+
+    def refresh(self, full=False):
+        """
+        Brings the mirror up to date with the arr.
+
+        Args:
+            full: Download the whole library even if the last full download is recent
+        """
+        utc_now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with ProgramSessionLocal() as db:
+            state = db.get(ArrMirrorState, self.arr_type)
+            last_sync = (state.historyCursor, state.lastFullSync) if state else None
+            stale_ids = set(
+                db.scalars(
+                    select(ArrItems.arrId)
+                    .where(ArrItems.arrType == self.arr_type)
+                    .where(ArrItems.stale == 1)
+                )
+            )
+            # Nothing is fetched with the read transaction open
+            db.rollback()
+
+            changed_ids = None
+            if (
+                not full
+                and last_sync is not None
+                and utc_now - last_sync[1] < ARR_FULL_SYNC_INTERVAL
+            ):
+                changed_ids = self._fetch_changed_ids(last_sync[0]) | stale_ids
+                if len(changed_ids) > ARR_MAX_INCREMENTAL_ITEMS:
+                    changed_ids = None
+
+            if changed_ids is None:
+                items = self._fetch_all()
+                known_ids = set(
+                    db.scalars(
+                        select(ArrItems.arrId).where(ArrItems.arrType == self.arr_type)
+                    )
+                )
+                removed_ids = known_ids - {item["id"] for item in items}
+                self._store_items(db, items, utc_now)
+                self._delete_items(db, removed_ids)
+                if self.arr_type == "sonarr":
+                    _delete_episodes(db, removed_ids)
+            else:
+                items = []
+                removed_ids = set()
+                for arr_id in changed_ids:
+                    try:
+                        items.append(self._fetch_item(arr_id))
+                    except PyarrResourceNotFound:
+                        removed_ids.add(arr_id)
+                self._store_items(db, items, utc_now)
+                self._delete_items(db, removed_ids)
+                # The history mostly holds file changes, which the series statistics may not show
+                if self.arr_type == "sonarr":
+                    _delete_episodes(db, changed_ids)
+
+            db.merge(
+                ArrMirrorState(
+                    arrType=self.arr_type,
+                    historyCursor=utc_now,
+                    lastFullSync=utc_now if changed_ids is None else last_sync[1],
+                )
+            )
+            db.commit()
+
+    def get_items(self, refresh=True):
+        """
+        Returns:
+            list: The movies or series as returned by the arr API
+        """
+        if refresh:
+            self.refresh()
+
+        with ProgramSessionLocal() as db:
+            return list(
+                db.scalars(
+                    select(ArrItems.data)
+                    .where(ArrItems.arrType == self.arr_type)
+                    .where(ArrItems.data.is_not(None))
+                    .order_by(ArrItems.arrId)
+                )
+            )
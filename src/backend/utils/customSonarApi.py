@@ -1,11 +1,34 @@
-from typing import Any, Union
+from typing import Any, Optional, Union
 
 from pyarr import SonarrAPI
-from pyarr.types import JsonObject
+from pyarr.request_handler import _process_response
+from pyarr.types import JsonArray, JsonObject
 from requests import Response
 
 
 class customSonarAPI(SonarrAPI):
+    # GET /episode?seriesId={id}
+    def get_series_episodes(
+        self, series_id: int, timeout: Optional[float] = None
+    ) -> JsonArray:
+        """Same as get_episode(series_id, series=True) with a timeout, pyarr waits forever
+
+        Args:
+            series_id (int): Database ID for series
+            timeout (float, optional): Seconds to wait for the response. Defaults to None.
+
+        Returns:
+            JsonArray: List of dictionaries with the episodes of the series
+        """
+        res = self.session.get(
+            self._request_url("episode", self.ver_uri),
+            headers={"X-Api-Key": self.api_key},
+            params={"seriesId": series_id},
+            auth=self.auth,
+            timeout=timeout,
+        )
+        return _process_response(res)
+
     def upd_series_editor(self, data: JsonObject) -> JsonObject:
         """The Updates operation allows to edit properties of multiple movies at once
 
@@ -1,10 +1,30 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class EmbyAPI:
-    def __init__(self, api_key, base_url):
+    def __init__(self, api_key, base_url, pool_size=10, timeout=(5, 120)):
         self.api_key = api_key
         self.base_url = base_url
+        # (connect, read) seconds, a hanging server should not block a worker until it is killed
+        self.timeout = timeout
+
+        # One keep-alive session per client so requests reuse the open connections
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"X-Emby-Token": self.api_key, "Accept-Encoding": "gzip, deflate"}
+        )
+        self._adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.requests_served = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self._stats_lock = threading.Lock()
 
     def _url_builder(self, endpoint, **kwargs):
         url = self.base_url + endpoint
@@ -23,31 +43,64 @@ class EmbyAPI:
         return url
 
     def _get_request(self, requested_url, method="GET"):
-        if method == "GET":
-            response = requests.get(
-                requested_url, headers={"X-Emby-Token": self.api_key}
-            )
-        elif method == "POST":
-            response = requests.post(
-                requested_url, headers={"X-Emby-Token": self.api_key}
-            )
-        elif method == "DELETE":
-            response = requests.delete(
-                requested_url, headers={"X-Emby-Token": self.api_key}
-            )
-        else:
+        if method not in ("GET", "POST", "DELETE"):
             raise Exception("Method not supported")
 
+        response = self.session.request(
+            method, requested_url, timeout=self.timeout, stream=True
+        )
+        # Read through urllib3, its tell() then counts the compressed bytes of chunked responses too
+        body = response.raw.read(decode_content=True)
+        with self._stats_lock:
+            self.requests_served += 1
+            self.bytes_received += response.raw.tell()
+            self.bytes_decoded += len(body)
+
         if response.status_code == 200:
-            return response.json()
+            return json.loads(body)
         elif response.status_code == 204:
             return None
         else:
             print(f"Error: {response.status_code}")
-            print(response.text)
+            print(body.decode(response.encoding or "utf-8", errors="replace"))
             print(response.url)
             return None
 
+    def get_connection_stats(self):
+        """
+        Returns:
+            dict: The connections opened and requests served, equal numbers mean no reuse,
+            the bytes of all response bodies as received, so compressed, and after decompressing
+        """
+        pools = self._adapter.poolmanager.pools
+        connections_opened = sum(
+            pools[key].num_connections for key in pools.keys() if key in pools
+        )
+        return {
+            "connections_opened": connections_opened,
+            "requests_served": self.requests_served,
+            "bytes_received": self.bytes_received,
+            "bytes_decoded": self.bytes_decoded,
+        }
+
+    @staticmethod
+    def _projection(fields):
+        """
+        Query parameters limiting the item DTOs to the base fields plus the given fields.
+        "UserData" enables the user data, the other names are optional item fields.
+        None requests the full DTOs.
+        """
+        if fields is None:
+            return {}
+        projection = {
+            "EnableImages": "false",
+            "EnableUserData": "true" if "UserData" in fields else "false",
+        }
+        optional_fields = [field for field in fields if field != "UserData"]
+        if optional_fields:
+            projection["Fields"] = ",".join(optional_fields)
+        return projection
+
     def test_connection(self):
         url = self._url_builder("/System/Info")
         return self._get_request(url)
@@ -56,36 +109,132 @@ class EmbyAPI:
         url = self._url_builder("/Users/Query")
         return self._get_request(url)["Items"]
 
-    def get_items(self, recursive=True, **kwargs):
-        url = self._url_builder("/Items", recursive=recursive, **kwargs)
+    def get_items(self, recursive=True, fields=None, **kwargs):
+        url = self._url_builder(
+            "/Items", recursive=recursive, **self._projection(fields), **kwargs
+        )
 
         return self._get_request(url)["Items"]
 
-    def get_user_items(self, user_id, recursive=True, **kwargs):
+    def iter_items(
+        self, recursive=True, page_size=1000, prefetch=True, fields=None, **kwargs
+    ):
+        """
+        Yields the items of /Items page by page, so huge libraries never have to fit in one response.
+
+        Args:
+            recursive: Include the items of sub folders
+            page_size: Amount of items requested per page
+            prefetch: Request the next page while the current one is consumed
+            fields: Fields the caller reads, None for the full item DTOs
+            **kwargs: Query parameters of the request
+
+        Returns:
+            Generator: The items, sorted by SortName and Id unless SortBy is given
+        """
+        return self._iter_pages(
+            "/Items",
+            page_size,
+            prefetch,
+            recursive=recursive,
+            **self._projection(fields),
+            **kwargs,
+        )
+
+    def iter_user_items(
+        self,
+        user_id,
+        recursive=True,
+        page_size=1000,
+        prefetch=True,
+        fields=None,
+        **kwargs,
+    ):
+        """Same as iter_items for the items of one user."""
+        return self._iter_pages(
+            f"/Users/{user_id}/Items",
+            page_size,
+            prefetch,
+            recursive=recursive,
+            **self._projection(fields),
+            **kwargs,
+        )
+
+    def _iter_pages(self, endpoint, page_size, prefetch, **kwargs):
+        # Without a fixed order items saved during the scan can move across pages,
+        # so they would be skipped or returned twice
+        kwargs = {"SortBy": "SortName,Id", "SortOrder": "Ascending", **kwargs}
+        total = None
+
+        def fetch_page(start_index):
+            url = self._url_builder(
+                endpoint, StartIndex=start_index, Limit=page_size, **kwargs
+            )
+            return self._get_request(url)
+
+        def is_last_page(page, start_index):
+            # The count of the first page, items added during the scan are left for the next one
+            return len(page["Items"]) < page_size or (
+                total is not None and start_index + page_size >= total
+            )
+
+        if not prefetch:
+            start_index = 0
+            while True:
+                page = fetch_page(start_index)
+                if total is None:
+                    total = page.get("TotalRecordCount")
+                yield from page["Items"]
+                if is_last_page(page, start_index):
+                    return
+                start_index += page_size
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            start_index = 0
+            next_page = executor.submit(fetch_page, start_index)
+            while True:
+                page = next_page.result()
+                if total is None:
+                    total = page.get("TotalRecordCount")
+                if is_last_page(page, start_index):
+                    yield from page["Items"]
+                    return
+                start_index += page_size
+                next_page = executor.submit(fetch_page, start_index)
+                yield from page["Items"]
+
+    def get_user_items(self, user_id, recursive=True, fields=None, **kwargs):
         url = self._url_builder(
-            f"/Users/{user_id}/Items", recursive=recursive, **kwargs
+            f"/Users/{user_id}/Items",
+            recursive=recursive,
+            **self._projection(fields),
+            **kwargs,
         )
 
         return self._get_request(url)["Items"]
 
-    def get_user_favorites(self, user_id, types=["Movie", "Series"]):
+    def get_user_favorites(self, user_id, types=["Movie", "Series"], fields=None):
         url_types = "".join(f"{item}%2C" for item in types)
         url = self._url_builder(
             f"/Users/{user_id}/Items",
             recursive=True,
             Filters="IsFavorite",
             IncludeItemTypes=url_types,
+            **self._projection(fields),
         )
         return self._get_request(url)["Items"]
 
-    def get_user_resume(self, user_id):
+    def get_user_resume(self, user_id, fields=None):
         url = self._url_builder(
-            f"/Users/{user_id}/Items/Resume", recursive=True, MediaTypes="Video"
+            f"/Users/{user_id}/Items/Resume",
+            recursive=True,
+            MediaTypes="Video",
+            **self._projection(fields),
         )
 
         return self._get_request(url)["Items"]
 
-    def get_user_played(self, user_id):
+    def get_user_played(self, user_id, fields=None):
         # Why if querying movie, episode and serie it does not return all series? ...
         items = []
         url = self._url_builder(
@@ -93,6 +242,7 @@ class EmbyAPI:
             recursive=True,
             Filters="IsPlayed",
             IncludeItemTypes="Movie,Episode",
+            **self._projection(fields),
         )
         items += self._get_request(url)["Items"]
         url = self._url_builder(
@@ -100,11 +250,25 @@ class EmbyAPI:
             recursive=True,
             Filters="IsPlayed",
             IncludeItemTypes="Series",
+            **self._projection(fields),
         )
         items += self._get_request(url)["Items"]
 
         return items
 
+    def get_user_changed_items(
+        self, user_id, since, types=["Movie", "Series", "Episode"], fields=None
+    ):
+        """Returns the items of which the user data (played, favorite, ...) changed since the ISO date."""
+        url = self._url_builder(
+            f"/Users/{user_id}/Items",
+            recursive=True,
+            MinDateLastSavedForUser=since,
+            IncludeItemTypes=",".join(types),
+            **self._projection(fields),
+        )
+        return self._get_request(url)["Items"]
+
     def get_media_libraries(self):
         url = self._url_builder("/Library/VirtualFolders/Query")
         return self._get_request(url)["Items"]
@@ -116,8 +280,8 @@ class EmbyAPI:
         )
         return self._get_request(url, "POST")
 
-    def get_playlist_items(self, id):
-        url = self._url_builder(f"/Playlists/{id}/Items")
+    def get_playlist_items(self, id, fields=None):
+        url = self._url_builder(f"/Playlists/{id}/Items", **self._projection(fields))
         return self._get_request(url)["Items"]
 
     def remove_items_from_playlist(self, id, entry_ids):
@@ -1,7 +1,12 @@
 import datetime
+import re
 
 from collections import defaultdict
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
+
+YEAR_SUFFIX_PATTERN = re.compile(r"\s*\((\d{4})\)$")
+# Arr item field per media server provider, as in the ProviderIds of an Emby/Jellyfin item
+PROVIDER_ID_FIELDS = {"tmdb": "tmdbId", "tvdb": "tvdbId", "imdb": "imdbId"}
 
 
 def get_start_time(
@@ -132,9 +137,78 @@ def classify_items_by_decay(
     return result
 
 
+class ArrMatcher:
+    """
+    Index of arr items to link media server items to, build it once and match every item against it.
+    Matches the same item as scanning the list would, the first one with the title or title and year.
+    """
+
+    def __init__(self, arr_items: List[dict]):
+        """
+        Args:
+            arr_items (list): A list of dictionaries, each containing 'title' and 'year' information.
+        """
+        self.by_title = {}
+        self.by_title_year = {}
+        self.by_provider_id = {}
+        for position, arr_item in enumerate(arr_items):
+            arr_title = arr_item["title"].casefold()
+            self.by_title.setdefault(arr_title, (position, arr_item))
+            self.by_title_year.setdefault(
+                (arr_title, arr_item.get("year")), (position, arr_item)
+            )
+            for provider, field in PROVIDER_ID_FIELDS.items():
+                if arr_item.get(field):
+                    self.by_provider_id.setdefault(
+                        (provider, str(arr_item[field]).casefold()), arr_item
+                    )
+
+    def match(self, media_server_item: dict) -> Optional[dict]:
+        """
+        Link an item from a media server to the corresponding arr item.
+        Provider IDs are tried first when the media server item has them, then the title.
+
+        Args:
+            media_server_item (dict): A dictionary containing information about the media server item, including 'Name'.
+
+        Returns:
+            dict: The matched arr item if a match is found, otherwise None.
+        """
+        for provider, provider_id in (
+            media_server_item.get("ProviderIds") or {}
+        ).items():
+            arr_item = self.by_provider_id.get(
+                (provider.casefold(), str(provider_id).casefold())
+            )
+            if arr_item is not None:
+                return arr_item
+
+        original_title = media_server_item["Name"].casefold()
+        year_match = YEAR_SUFFIX_PATTERN.search(original_title)
+        title = original_title[: year_match.start()] if year_match else original_title
+        year = (
+            int(year_match.group(1))
+            if year_match and 1900 <= int(year_match.group(1)) <= 2200
+            else None
+        )
+
+        matches = [
+            found
+            for found in (
+                self.by_title.get(original_title),
+                self.by_title_year.get((title, year)),
+            )
+            if found is not None
+        ]
+        if matches:
+            return min(matches, key=lambda found: found[0])[1]
+        return None
+
+
 def link_arr_to_media_server(media_server_item: dict, arr_items: list) -> dict:
     """
     Link an item from a media server to a corresponding item in a list.
+    Use an ArrMatcher when linking more than one item to the same list.
 
     Args:
         media_server_item (dict): A dictionary containing information about the media server item, including 'Name'.
@@ -143,22 +217,33 @@ def link_arr_to_media_server(media_server_item: dict, arr_items: list) -> dict:
     Returns:
         dict: The matched dictionary from arr_items if a match is found, otherwise None.
     """
-    import re
-
-    original_title = media_server_item["Name"].casefold()
-    title = re.sub(r"\s*\(\d{4}\)$", "", original_title)  # Remove (year) from the title
-    year_match = re.search(r"\((\d{4})\)$", original_title)
-    year = (
-        int(year_match.group(1))
-        if year_match and 1900 <= int(year_match.group(1)) <= 2200
-        else None
-    )
+    return ArrMatcher(arr_items).match(media_server_item)
+
+
+def select_targeted_items(
+    arr_items: List[dict],
+    ids: Optional[List[int]] = None,
+    media_server_items: Optional[List[dict]] = None,
+) -> List[dict]:
+    """
+    Select the arr items an event was received for.
 
-    for arr_item in arr_items:
-        arr_title = arr_item["title"].casefold()
-        arr_year = arr_item.get("year")
-        if arr_title == original_title or (title == arr_title and year == arr_year):
-            return arr_item
+    Args:
+        arr_items (list): All items of the arr.
+        ids (list, optional): Arr ids of the items.
+        media_server_items (list, optional): Items of the media server with 'Name' and 'ProviderIds', linked like the scheduled runs link them.
+
+    Returns:
+        list: The arr items matching any of the ids or media server items.
+    """
+    target_ids = set(ids or [])
+    matcher = ArrMatcher(arr_items)
+    for media_server_item in media_server_items or []:
+        arr_item = matcher.match(media_server_item)
+        if arr_item is not None:
+            target_ids.add(arr_item["id"])
+
+    return [arr_item for arr_item in arr_items if arr_item["id"] in target_ids]
 
 
 def combine_tuples(tuples: List[Tuple[int, List[int]]]) -> List[Tuple[int, List[int]]]:
@@ -1,46 +1,160 @@
 import datetime
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+from sqlalchemy import Integer, bindparam, cast, delete, func, insert, select, update
 from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
 
-from database.database import get_program_db
+from database.database import ProgramScopedSession
 from models.media import (
+    MediaServerSnapshots,
+    MediaServerSyncCursors,
     FavoriteMovies,
+    FavoriteMovieUsers,
     FavoriteSeries,
+    FavoriteSeriesUsers,
     OnResumeMovies,
+    OnResumeMovieUsers,
     OnResumeSeries,
+    OnResumeSeriesUsers,
     PlayedMovies,
+    PlayedMovieUsers,
     PlayedSeries,
+    PlayedSeriesUsers,
     PlayedEpisodes,
+    PlayedEpisodeUsers,
 )
 from utils.custom_emby_api import EmbyAPI
 from utils.custom_jellyfin_api import JellyfinAPI
 
+# Seconds between full resyncs of the played and favorite items of a user,
+# the syncs in between only fetch the items of which the user data changed
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+# Seconds the incremental syncs look back before the cursor to cover clock differences
+SYNC_CURSOR_OVERLAP = 5 * 60
+
+# Link table holding the users of every media table
+USER_LINK_TABLES = {
+    FavoriteMovies: FavoriteMovieUsers,
+    FavoriteSeries: FavoriteSeriesUsers,
+    OnResumeMovies: OnResumeMovieUsers,
+    OnResumeSeries: OnResumeSeriesUsers,
+    PlayedMovies: PlayedMovieUsers,
+    PlayedSeries: PlayedSeriesUsers,
+    PlayedEpisodes: PlayedEpisodeUsers,
+}
+
 
 class MediaServerinteracter:
-    def __init__(self, media_server_type, media_server_base_url, media_server_api_key):
+    # Fields each call reads besides the base item fields (Id, Name, Type, SeriesId,
+    # SeriesName, index numbers, Artists, Album), the rest is left out of the responses
+    FAVORITE_FIELDS = ["ProviderIds"]
+    RESUME_FIELDS = ["ProviderIds"]
+    PLAYED_FIELDS = ["ProviderIds"]
+    CHANGED_FIELDS = ["UserData", "ProviderIds"]
+    UNMARK_FIELDS = ["UserData"]
+    TRACK_FIELDS = []
+    PLAYLIST_FIELDS = []
+
+    def __init__(
+        self,
+        media_server_type,
+        media_server_base_url,
+        media_server_api_key,
+        max_concurrent_requests=4,
+    ):
         self.media_server_type = media_server_type
         self.media_server_base_url = media_server_base_url
         self.media_server_api_key = media_server_api_key
+        self.max_concurrent_requests = max_concurrent_requests
 
         self.media_server_base_url = f"{media_server_base_url.rstrip('/')}"
 
+        # Every concurrent user fetch gets its own pooled connection
+        pool_size = max(4, max_concurrent_requests)
         if self.media_server_type == "emby":
             self.client = EmbyAPI(
-                self.media_server_api_key, f"{self.media_server_base_url}/emby"
+                self.media_server_api_key,
+                f"{self.media_server_base_url}/emby",
+                pool_size=pool_size,
             )
         elif self.media_server_type == "jellyfin":
             self.client = JellyfinAPI(
-                self.media_server_api_key, self.media_server_base_url
+                self.media_server_api_key,
+                self.media_server_base_url,
+                pool_size=pool_size,
             )
         else:
             raise Exception("Media server type not supported " + self.media_server_type)
 
+        # Per thread flags of _write_transaction and read_snapshot
+        self._local = threading.local()
+
         if self.test_connection():
             self.client_users = self.client.get_users()
 
-        self.db: Session = next(get_program_db())
+    @property
+    def db(self) -> Session:
+        """The session of the calling thread, the interacter is shared by API requests and worker threads."""
+        return ProgramScopedSession()
+
+    def _end_read(self):
+        """
+        Closes the session of the calling thread after reading, unless it is inside read_snapshot.
+        An open read transaction keeps its old WAL snapshot and blocks checkpoints.
+        """
+        if getattr(self._local, "reading", False):
+            return
+        ProgramScopedSession.remove()
+
+    def _commit(self):
+        """Commits the writes of the calling thread, inside _write_transaction they wait for its end."""
+        if getattr(self._local, "writing", False):
+            self.db.flush()
+        else:
+            self.db.commit()
+
+    @contextmanager
+    def _write_transaction(self):
+        """
+        Commits all writes of the calling thread inside at once, so readers see all or none of a sync.
+        Fetch from the media server before entering, the write lock is held until the end.
+        """
+        if getattr(self._local, "writing", False):
+            yield
+            return
+
+        self._local.writing = True
+        try:
+            yield
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        finally:
+            self._local.writing = False
+            ProgramScopedSession.remove()
+
+    @contextmanager
+    def read_snapshot(self):
+        """
+        Lets all getters called by the calling thread inside read from one read transaction,
+        so they see the same snapshot even while the next one is written.
+
+        Yields:
+            int: The version of the snapshot that is read
+        """
+        self._local.reading = True
+        try:
+            # pysqlite does not start transactions for selects by itself, the first select
+            # after BEGIN fixes the snapshot the other getters read
+            self.db.connection().exec_driver_sql("BEGIN")
+            yield self.get_snapshot_version()
+        finally:
+            self._local.reading = False
+            self._end_read()
 
     def test_connection(self):
         if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
@@ -54,6 +168,9 @@ class MediaServerinteracter:
         else:
             raise Exception("Media server type not supported " + self.media_server_type)
 
+    def get_connection_stats(self):
+        return self.client.get_connection_stats()
+
     def _get_numbers_from_string(self, input_string):
         # Use regular expression to extract numbers
         numbers = re.findall(r"\d+", input_string)
@@ -62,6 +179,20 @@ class MediaServerinteracter:
         numbers = [int(num) for num in numbers]
         return numbers
 
+    def _fetch_per_user(self, fetch, users=None):
+        """
+        Calls fetch for every user with at most max_concurrent_requests at the same time.
+        Only the requests run in parallel, the results are written to the db by the caller.
+
+        Returns:
+            list: Tuples of user and fetch result, in the order of the users
+        """
+        users = self.client_users if users is None else users
+        with ThreadPoolExecutor(
+            max_workers=max(1, self.max_concurrent_requests)
+        ) as executor:
+            return list(zip(users, executor.map(fetch, users)))
+
     def get_users(self):
         users = None
 
@@ -73,134 +204,340 @@ class MediaServerinteracter:
 
         return users
 
+    def _apply_user_changes(
+        self, user_id, added_items, removed_ids, table, media_ids=None
+    ):
+        """
+        Adds the user to the added items and removes them from the removed media IDs
+        with bulk statements in one transaction. Only the link rows of the user are
+        written, rows without users left are deleted.
+
+        Args:
+            user_id: The user to add or remove
+            added_items: Items the user has
+            removed_ids: Media IDs the user no longer has, None for all items not in added_items
+            table: The media table
+            media_ids: Only read the rows of these media IDs, None for the whole table
+        """
+        link_table = USER_LINK_TABLES[table]
+        columns = table.__table__.c
+        link_columns = link_table.__table__.c
+        utc_now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+
+        has_provider_ids = "providerIds" in columns
+        row_query = select(
+            columns.mediaId,
+            columns.id,
+            columns.providerIds.is_(None) if has_provider_ids else False,
+        )
+        if media_ids is not None:
+            row_query = row_query.where(columns.mediaId.in_(media_ids))
+        row_ids = {}
+        # Rows stored before provider IDs were synced
+        missing_provider_ids = set()
+        for media_id, row_id, provider_ids_missing in self.db.execute(row_query):
+            row_ids[str(media_id)] = row_id
+            if provider_ids_missing:
+                missing_provider_ids.add(str(media_id))
+        linked_query = select(link_columns.itemId).where(link_columns.userId == user_id)
+        if media_ids is not None:
+            linked_query = linked_query.where(
+                link_columns.itemId.in_(list(row_ids.values()))
+            )
+        linked_ids = set(self.db.scalars(linked_query))
+
+        added = {str(item["Id"]): item for item in added_items}
+        inserts = [
+            {
+                "name": item["Name"],
+                "mediaId": item["Id"],
+                "date": utc_now,
+                **(
+                    {"providerIds": item.get("ProviderIds")} if has_provider_ids else {}
+                ),
+                **item.get("Columns", {}),
+            }
+            for media_id, item in added.items()
+            if media_id not in row_ids
+        ]
+        provider_id_updates = [
+            {"row_id": row_ids[media_id], "provider_ids": item["ProviderIds"]}
+            for media_id, item in added.items()
+            if media_id in missing_provider_ids and item.get("ProviderIds")
+        ]
+        if provider_id_updates:
+            self.db.execute(
+                update(table.__table__)
+                .where(columns.id == bindparam("row_id"))
+                .values(
+                    providerIds=bindparam(
+                        "provider_ids", type_=columns.providerIds.type
+                    )
+                ),
+                provider_id_updates,
+            )
+        if inserts:
+            # Another process may have inserted the same item since it was read,
+            # those are skipped by the unique mediaId index and read back below
+            for media_id, row_id in self.db.execute(
+                insert(table.__table__)
+                .prefix_with("OR IGNORE")
+                .returning(columns.mediaId, columns.id),
+                inserts,
+            ):
+                row_ids[str(media_id)] = row_id
+            skipped_ids = [
+                item["mediaId"]
+                for item in inserts
+                if str(item["mediaId"]) not in row_ids
+            ]
+            for i in range(0, len(skipped_ids), 500):
+                for media_id, row_id in self.db.execute(
+                    select(columns.mediaId, columns.id).where(
+                        columns.mediaId.in_(skipped_ids[i : i + 500])
+                    )
+                ):
+                    row_ids[str(media_id)] = row_id
+
+        added_row_ids = {row_ids[media_id] for media_id in added}
+        new_link_ids = sorted(added_row_ids - linked_ids)
+        if removed_ids is None:
+            removed_row_ids = sorted(linked_ids - added_row_ids)
+        else:
+            removed_row_ids = sorted(
+                {
+                    row_ids[media_id]
+                    for media_id in removed_ids
+                    if media_id in row_ids and media_id not in added
+                }
+                & linked_ids
+            )
+
+        if new_link_ids:
+            self.db.execute(
+                insert(link_table.__table__),
+                [{"itemId": row_id, "userId": user_id} for row_id in new_link_ids],
+            )
+        for i in range(0, len(new_link_ids), 500):
+            self.db.execute(
+                update(table.__table__)
+                .where(columns.id.in_(new_link_ids[i : i + 500]))
+                .values(date=utc_now)
+            )
+        for i in range(0, len(removed_row_ids), 500):
+            chunk = removed_row_ids[i : i + 500]
+            self.db.execute(
+                delete(link_table.__table__)
+                .where(link_columns.userId == user_id)
+                .where(link_columns.itemId.in_(chunk))
+            )
+            self.db.execute(
+                delete(table.__table__)
+                .where(columns.id.in_(chunk))
+                .where(
+                    ~select(link_columns.itemId)
+                    .where(link_columns.itemId == columns.id)
+                    .exists()
+                )
+            )
+        self._commit()
+
+    def _linked_rows(self, table, ignore_user_ids):
+        """Query of the rows that have at least one user not in ignore_user_ids."""
+        link_table = USER_LINK_TABLES[table]
+        return self.db.query(table).filter(
+            self.db.query(link_table)
+            .filter(link_table.itemId == table.id)
+            .filter(link_table.userId.notin_(ignore_user_ids))
+            .exists()
+        )
+
     def update_db(self, user_id, items, table):
+        """Reconciles the table with the full list of items of the user."""
+        self._apply_user_changes(user_id, items, None, table)
+
+    def update_db_changes(self, user_id, added_items, removed_items, table):
+        """Adds the user to the added items and removes them from the removed items, other rows are left alone."""
+        removed_ids = [str(item["Id"]) for item in removed_items]
+        media_ids = [item["Id"] for item in added_items] + removed_ids
+        if not media_ids:
+            return
+        self._apply_user_changes(user_id, added_items, removed_ids, table, media_ids)
+
+    def _get_sync_since(self, user_id, sync_type):
+        """
+        Returns the ISO date to fetch the changed user data from, None if a full resync is due.
+        """
+        cursor = (
+            self.db.query(MediaServerSyncCursors)
+            .filter_by(userId=user_id, syncType=sync_type)
+            .first()
+        )
         utc_now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-        for item in items:
-            media_id = item["Id"]
-            media_name = item["Name"]
-
-            # Check if the favorite already exists in the database
-            existing_item = self.db.query(table).filter_by(mediaId=media_id).first()
-
-            if existing_item:
-                if user_id not in existing_item.userIds:
-                    existing_item.userIds.append(user_id)
-                    existing_item.date = utc_now
-                    flag_modified(existing_item, "userIds")
-            else:
-                new_favorite = table(
-                    name=media_name, mediaId=media_id, userIds=[user_id], date=utc_now
+        if cursor is None or utc_now - cursor.lastFullSync >= FULL_SYNC_INTERVAL:
+            return None
+
+        since = datetime.datetime.fromtimestamp(
+            cursor.cursor - SYNC_CURSOR_OVERLAP, tz=datetime.timezone.utc
+        )
+        return since.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def _save_sync_cursor(self, user_id, sync_type, sync_start, full_sync):
+        cursor = (
+            self.db.query(MediaServerSyncCursors)
+            .filter_by(userId=user_id, syncType=sync_type)
+            .first()
+        )
+        if cursor is None:
+            cursor = MediaServerSyncCursors(
+                userId=user_id, syncType=sync_type, lastFullSync=sync_start
+            )
+            self.db.add(cursor)
+        cursor.cursor = sync_start
+        if full_sync:
+            cursor.lastFullSync = sync_start
+        self._commit()
+
+    def _get_user_syncs(self, sync_type, users=None):
+        """Returns per user the user ID, ISO date to sync from (None for a full sync) and sync start."""
+        sync_start = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        user_syncs = [
+            (user["Id"], self._get_sync_since(user["Id"], sync_type), sync_start)
+            for user in (self.client_users if users is None else users)
+        ]
+        # The fetches take a while, do not hold the read transaction meanwhile
+        self._end_read()
+        return user_syncs
+
+    def _fetch_favorites(self, users=None):
+        def fetch(sync):
+            user_id, since, _ = sync
+            if since is None:
+                return self.client.get_user_favorites(
+                    user_id, fields=self.FAVORITE_FIELDS
                 )
-                self.db.add(new_favorite)
-
-        # Remove the user ID from items they no longer favorite
-        item_ids = [item["Id"] for item in items]
-        for item in self.db.query(table).all():
-            if str(item.mediaId) not in str(item_ids):
-                if user_id in item.userIds:
-                    item.userIds.remove(user_id)
-                    if not item.userIds:
-                        self.db.delete(item)
-                    else:
-                        flag_modified(item, "userIds")
-        self.db.commit()
+            return self.client.get_user_changed_items(
+                user_id, since, ["Movie", "Series"], fields=self.CHANGED_FIELDS
+            )
 
-    def update_favorites(self):
-        if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            for user in self.client_users:
-                user_id = user["Id"]
-                user_favorites = self.client.get_user_favorites(user_id)
-                movies = [d for d in user_favorites if d["Type"] == "Movie"]
-                series = [d for d in user_favorites if d["Type"] == "Series"]
+        return self._fetch_per_user(fetch, self._get_user_syncs("favorites", users))
+
+    def _write_favorites(self, fetched):
+        for (user_id, since, sync_start), items in fetched:
+            if since is None:
+                movies = [d for d in items if d["Type"] == "Movie"]
+                series = [d for d in items if d["Type"] == "Series"]
 
                 self.update_db(user_id, movies, FavoriteMovies)
                 self.update_db(user_id, series, FavoriteSeries)
+            else:
+                for item_type, table in (
+                    ("Movie", FavoriteMovies),
+                    ("Series", FavoriteSeries),
+                ):
+                    changed = [d for d in items if d["Type"] == item_type]
+                    self.update_db_changes(
+                        user_id,
+                        [d for d in changed if d["UserData"]["IsFavorite"]],
+                        [d for d in changed if not d["UserData"]["IsFavorite"]],
+                        table,
+                    )
 
-    def get_all_favorites(self, ignore_user_ids=[]):
-        try:
-            self.update_favorites()
-        except:
-            pass
+            self._save_sync_cursor(user_id, "favorites", sync_start, since is None)
+
+    def update_favorites(self):
+        if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
+            fetched = self._fetch_favorites()
+            with self._write_transaction():
+                self._write_favorites(fetched)
+                self._add_snapshot()
+
+    def get_all_favorites(self, ignore_user_ids=[], refresh=True):
+        if refresh:
+            try:
+                self.update_favorites()
+            except:
+                pass
 
-        ignore_user_ids_set = set(ignore_user_ids)
         favorites = {"Movies": [], "Series": []}
 
-        movie_rows = self.db.query(FavoriteMovies).all()
-        for serie in movie_rows:
-            userIds_set = set(serie.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
+        for serie in self._linked_rows(FavoriteMovies, ignore_user_ids):
             favorites["Movies"].append(
                 {
                     "Name": serie.name,
                     "Id": serie.mediaId,
+                    "ProviderIds": serie.providerIds or {},
                     "Date": datetime.datetime.fromtimestamp(
                         serie.date, tz=datetime.timezone.utc
                     ),
                 }
             )
-        serie_rows = self.db.query(FavoriteSeries).all()
-        for serie in serie_rows:
-            userIds_set = set(serie.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
+        for serie in self._linked_rows(FavoriteSeries, ignore_user_ids):
             favorites["Series"].append(
                 {
                     "Name": serie.name,
                     "Id": serie.mediaId,
+                    "ProviderIds": serie.providerIds or {},
                     "Date": datetime.datetime.fromtimestamp(
                         serie.date, tz=datetime.timezone.utc
                     ),
                 }
             )
 
+        self._end_read()
         return favorites
 
+    def _fetch_on_resume(self, users=None):
+        return self._fetch_per_user(
+            lambda user: self.client.get_user_resume(
+                user["Id"], fields=self.RESUME_FIELDS
+            ),
+            users,
+        )
+
+    def _write_on_resume(self, fetched):
+        for user, user_favorites in fetched:
+            user_id = user["Id"]
+            movies = [d for d in user_favorites if d["Type"] == "Movie"]
+            episodes = [d for d in user_favorites if d["Type"] == "Episode"]
+            series = []
+            for serie in episodes:
+                new_format = {}
+                new_format["Name"] = serie["SeriesName"]
+                new_format["Id"] = serie["SeriesId"]
+                series.append(new_format)
+
+            self.update_db(user_id, movies, OnResumeMovies)
+            self.update_db(user_id, series, OnResumeSeries)
+
     def update_on_resume(self):
         if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            for user in self.client_users:
-                user_id = user["Id"]
-                user_favorites = self.client.get_user_resume(user["Id"])
-                movies = [d for d in user_favorites if d["Type"] == "Movie"]
-                episodes = [d for d in user_favorites if d["Type"] == "Episode"]
-                series = []
-                for serie in episodes:
-                    new_format = {}
-                    new_format["Name"] = serie["SeriesName"]
-                    new_format["Id"] = serie["SeriesId"]
-                    series.append(new_format)
-
-                self.update_db(user_id, movies, OnResumeMovies)
-                self.update_db(user_id, series, OnResumeSeries)
-
-    def get_on_resume(self, ignore_user_ids=[]):
-        try:
-            self.update_on_resume()
-        except:
-            pass
+            fetched = self._fetch_on_resume()
+            with self._write_transaction():
+                self._write_on_resume(fetched)
+                self._add_snapshot()
+
+    def get_on_resume(self, ignore_user_ids=[], refresh=True):
+        if refresh:
+            try:
+                self.update_on_resume()
+            except:
+                pass
 
-        ignore_user_ids_set = set(ignore_user_ids)
         favorites = {"Movies": [], "Series": []}
 
-        movie_rows = self.db.query(OnResumeMovies).all()
-        for movie in movie_rows:
-            userIds_set = set(movie.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
+        for movie in self._linked_rows(OnResumeMovies, ignore_user_ids):
             favorites["Movies"].append(
                 {
                     "Name": movie.name,
                     "Id": movie.mediaId,
+                    "ProviderIds": movie.providerIds or {},
                     "Date": datetime.datetime.fromtimestamp(
                         movie.date, tz=datetime.timezone.utc
                     ),
                 }
             )
-        serie_rows = self.db.query(OnResumeSeries).all()
-        for serie in serie_rows:
-            userIds_set = set(serie.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
+        for serie in self._linked_rows(OnResumeSeries, ignore_user_ids):
             favorites["Series"].append(
                 {
                     "Name": serie.name,
@@ -211,241 +548,334 @@ class MediaServerinteracter:
                 }
             )
 
+        self._end_read()
         return favorites
 
-    def update_played(self):
-        if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            for user in self.client_users:
-                user_id = user["Id"]
-                user_played = self.client.get_user_played(user["Id"])
-                movies = [d for d in user_played if d["Type"] == "Movie"]
-                series = [d for d in user_played if d["Type"] == "Series"]
-                episodes = [d for d in user_played if d["Type"] == "Episode"]
-                episodes_formatted = []
-                for episode in episodes:
-                    new_format = {}
-                    new_format["Name"] = episode["SeriesName"]
-                    new_format["Id"] = (
-                        f'{episode["SeriesId"]}S{episode["ParentIndexNumber"]}E{episode["IndexNumber"]}'
-                    )
-                    episodes_formatted.append(new_format)
+    @staticmethod
+    def _format_played_episode(episode):
+        return {
+            "Name": episode["SeriesName"],
+            "Id": f'{episode["SeriesId"]}S{episode["ParentIndexNumber"]}E{episode["IndexNumber"]}',
+            "Columns": {
+                "seriesId": episode["SeriesId"],
+                "seasonNumber": episode["ParentIndexNumber"],
+                "episodeNumber": episode["IndexNumber"],
+            },
+        }
+
+    def _fetch_played(self, users=None):
+        def fetch(sync):
+            user_id, since, _ = sync
+            if since is None:
+                return self.client.get_user_played(user_id, fields=self.PLAYED_FIELDS)
+            return self._fetch_played_changes(user_id, since)
+
+        return self._fetch_per_user(fetch, self._get_user_syncs("played", users))
+
+    def _write_played(self, fetched):
+        for (user_id, since, sync_start), items in fetched:
+            if since is None:
+                movies = [d for d in items if d["Type"] == "Movie"]
+                series = [d for d in items if d["Type"] == "Series"]
+                episodes = [d for d in items if d["Type"] == "Episode"]
+                episodes_formatted = [
+                    self._format_played_episode(episode) for episode in episodes
+                ]
 
                 self.update_db(user_id, movies, PlayedMovies)
                 self.update_db(user_id, series, PlayedSeries)
                 self.update_db(user_id, episodes_formatted, PlayedEpisodes)
+            else:
+                self._update_played_changes(user_id, items)
 
-    def get_played(self, ignore_user_ids=[]):
-        try:
-            self.update_played()
-        except:
-            pass
+            self._save_sync_cursor(user_id, "played", sync_start, since is None)
+
+    def update_played(self):
+        if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
+            fetched = self._fetch_played()
+            with self._write_transaction():
+                self._write_played(fetched)
+                self._add_snapshot()
+
+    def _fetch_played_changes(self, user_id, since):
+        changed = self.client.get_user_changed_items(
+            user_id, since, fields=self.CHANGED_FIELDS
+        )
+
+        # The played state of a series follows from its episodes, so fetch the series
+        # of changed episodes as their own user data is not always saved with it
+        series_ids = {d["Id"] for d in changed if d["Type"] == "Series"}
+        missing_series_ids = {
+            d["SeriesId"] for d in changed if d["Type"] == "Episode"
+        } - series_ids
+        if missing_series_ids:
+            changed += self.client.get_user_items(
+                user_id,
+                fields=self.CHANGED_FIELDS,
+                Ids=",".join(sorted(missing_series_ids)),
+            )
+        return changed
+
+    def _update_played_changes(self, user_id, changed):
+        movies = [d for d in changed if d["Type"] == "Movie"]
+        series = [d for d in changed if d["Type"] == "Series"]
+        episodes = [
+            d
+            for d in changed
+            if d["Type"] == "Episode"
+            and d.get("ParentIndexNumber") is not None
+            and d.get("IndexNumber") is not None
+        ]
+
+        self.update_db_changes(
+            user_id,
+            [d for d in movies if d["UserData"]["Played"]],
+            [d for d in movies if not d["UserData"]["Played"]],
+            PlayedMovies,
+        )
+        self.update_db_changes(
+            user_id,
+            [d for d in series if d["UserData"]["Played"]],
+            [d for d in series if not d["UserData"]["Played"]],
+            PlayedSeries,
+        )
+        self.update_db_changes(
+            user_id,
+            [
+                self._format_played_episode(d)
+                for d in episodes
+                if d["UserData"]["Played"]
+            ],
+            [
+                self._format_played_episode(d)
+                for d in episodes
+                if not d["UserData"]["Played"]
+            ],
+            PlayedEpisodes,
+        )
+
+    def get_played(self, ignore_user_ids=[], refresh=True):
+        if refresh:
+            try:
+                self.update_played()
+            except:
+                pass
 
-        ignore_user_ids_set = set(ignore_user_ids)
         played = {"Movies": [], "Series": [], "Episodes": []}
 
-        movie_rows = self.db.query(PlayedMovies).all()
-        for movie in movie_rows:
-            userIds_set = set(movie.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
+        for movie in self._linked_rows(PlayedMovies, ignore_user_ids):
             played["Movies"].append(
                 {
                     "Name": movie.name,
                     "Id": movie.mediaId,
+                    "ProviderIds": movie.providerIds or {},
                     "Date": datetime.datetime.fromtimestamp(
                         movie.date, tz=datetime.timezone.utc
                     ),
                 }
             )
-        serie_rows = self.db.query(PlayedSeries).all()
-        for serie in serie_rows:
-            userIds_set = set(serie.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
+        for serie in self._linked_rows(PlayedSeries, ignore_user_ids):
             played["Series"].append(
                 {
                     "Name": serie.name,
                     "Id": serie.mediaId,
+                    "ProviderIds": serie.providerIds or {},
                     "Date": datetime.datetime.fromtimestamp(
                         serie.date, tz=datetime.timezone.utc
                     ),
                 }
             )
-        episode_rows = self.db.query(PlayedEpisodes).all()
-        for episode in episode_rows:
-            userIds_set = set(episode.userIds)
-            if len(userIds_set - ignore_user_ids_set) == 0:
-                continue
-            split = episode.mediaId.split("S")
-            _id = split[0]
-            split = split[1].split("E")
-            season_number = split[0]
-            episode_number = split[1]
+        for episode in self._linked_rows(PlayedEpisodes, ignore_user_ids):
             played["Episodes"].append(
                 {
                     "Name": episode.name,
-                    "Id": _id,
-                    "Season": season_number,
-                    "Episode": episode_number,
+                    "Id": episode.seriesId,
+                    "Season": str(episode.seasonNumber),
+                    "Episode": str(episode.episodeNumber),
                     "Date": datetime.datetime.fromtimestamp(
                         episode.date, tz=datetime.timezone.utc
                     ),
                 }
             )
 
+        self._end_read()
         return played
 
-    def get_max_played_episodes(self, ignore_user_ids=[]):
-        try:
-            self.update_played()
-        except:
-            pass
-
-        ignore_user_ids_set = set(ignore_user_ids)
-        episode_rows = self.db.query(PlayedEpisodes).all()
-
-        max_episodes_per_show_per_user = {}
-
-        for episode in episode_rows:
-            user_ids_set = set(episode.userIds)
-            if len(user_ids_set - ignore_user_ids_set) == 0:
-                continue
-
-            split = episode.mediaId.split("S")
-            _id = split[0]
-            split = split[1].split("E")
-            season_number = int(split[0])
-            episode_number = int(split[1])
-
-            for user_id in user_ids_set:
-                if user_id in ignore_user_ids_set:
-                    continue
-
-                show_key = (user_id, _id)
-                current_episode = {"Season": season_number, "Episode": episode_number}
-
-                if show_key not in max_episodes_per_show_per_user:
-                    max_episodes_per_show_per_user[show_key] = {
-                        "Name": episode.name,
-                        "Id": _id,
-                        "Episodes": [current_episode],
-                        "Date": datetime.datetime.fromtimestamp(
-                            episode.date, tz=datetime.timezone.utc
-                        ),
-                    }
-                else:
-                    # Check if the current episode is higher
-                    max_season = max_episodes_per_show_per_user[show_key]["Episodes"][
-                        -1
-                    ]["Season"]
-                    max_episode = max_episodes_per_show_per_user[show_key]["Episodes"][
-                        -1
-                    ]["Episode"]
-                    if (season_number > max_season) or (
-                        season_number == max_season and episode_number > max_episode
-                    ):
-                        max_episodes_per_show_per_user[show_key]["Episodes"][
-                            -1
-                        ] = current_episode
-                        max_episodes_per_show_per_user[show_key]["Date"] = (
-                            datetime.datetime.fromtimestamp(
-                                episode.date, tz=datetime.timezone.utc
-                            )
-                        )
+    def get_max_played_episodes(self, ignore_user_ids=[], refresh=True):
+        if refresh:
+            try:
+                self.update_played()
+            except:
+                pass
+
+        # With a single max() SQLite takes the other columns from the row holding the maximum,
+        # so this returns the furthest played episode per user per show. Episodes without
+        # a position can not be compared and strings would sort after every integer
+        max_episodes_per_show_per_user = (
+            self.db.query(
+                PlayedEpisodeUsers.userId,
+                PlayedEpisodes.seriesId,
+                PlayedEpisodes.name,
+                PlayedEpisodes.seasonNumber,
+                PlayedEpisodes.episodeNumber,
+                PlayedEpisodes.date,
+                func.max(
+                    cast(PlayedEpisodes.seasonNumber, Integer) * 100000
+                    + cast(PlayedEpisodes.episodeNumber, Integer)
+                ),
+            )
+            .join(PlayedEpisodes, PlayedEpisodes.id == PlayedEpisodeUsers.itemId)
+            .filter(PlayedEpisodeUsers.userId.notin_(ignore_user_ids))
+            .filter(PlayedEpisodes.seasonNumber.isnot(None))
+            .filter(PlayedEpisodes.episodeNumber.isnot(None))
+            .group_by(PlayedEpisodeUsers.userId, PlayedEpisodes.seriesId)
+        )
 
         # Combine episodes by show
         combined_episodes = {}
-        for key, value in max_episodes_per_show_per_user.items():
-            show_id = value["Id"]
+        for (
+            _,
+            show_id,
+            name,
+            season_number,
+            episode_number,
+            date,
+            _,
+        ) in max_episodes_per_show_per_user:
+            current_episode = {"Season": season_number, "Episode": episode_number}
             if show_id not in combined_episodes:
-                combined_episodes[show_id] = value
+                combined_episodes[show_id] = {
+                    "Name": name,
+                    "Id": show_id,
+                    "Episodes": [current_episode],
+                    "Date": datetime.datetime.fromtimestamp(
+                        date, tz=datetime.timezone.utc
+                    ),
+                }
             else:
-                combined_episodes[show_id]["Episodes"].append(value["Episodes"][-1])
+                combined_episodes[show_id]["Episodes"].append(current_episode)
 
+        self._end_read()
         return list(combined_episodes.values())
 
+    def update_snapshot(self, user_ids=None):
+        """
+        Syncs the favorites, on resume and played items of all users once and stores it as a new snapshot.
+        Everything is fetched first and then written in one transaction with the snapshot row,
+        so the getters inside read_snapshot never see half of a snapshot.
+
+        Args:
+            user_ids: Only sync these users, like the users of a webhook event, the others keep their data
+
+        Returns:
+            int: The version of the new snapshot
+        """
+        users = (
+            None
+            if user_ids is None
+            else [user for user in self.client_users if user["Id"] in user_ids]
+        )
+        fetched = []
+        for fetch, write in (
+            (self._fetch_favorites, self._write_favorites),
+            (self._fetch_on_resume, self._write_on_resume),
+            (self._fetch_played, self._write_played),
+        ):
+            try:
+                fetched.append((write, fetch(users)))
+            except:
+                pass
+
+        with self._write_transaction():
+            for write, items in fetched:
+                write(items)
+            snapshot_id = self._add_snapshot()
+        return snapshot_id
+
+    def _add_snapshot(self):
+        """
+        Adds a snapshot row to the running write transaction. Every write of the synced tables
+        gets a new version, so a reader can tell when the data changed since a version.
+
+        Returns:
+            int: The version of the new snapshot
+        """
+        snapshot = MediaServerSnapshots(
+            date=int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        )
+        self.db.add(snapshot)
+        self.db.flush()
+        return snapshot.id
+
+    def get_snapshot_version(self):
+        snapshot = (
+            self.db.query(MediaServerSnapshots)
+            .order_by(MediaServerSnapshots.id.desc())
+            .first()
+        )
+        snapshot_id = snapshot.id if snapshot else None
+        self._end_read()
+        return snapshot_id
+
     def unmark_favorite_played_items(self, played_item_types=["Episode"]):
         if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            for user in self.client_users:
-                user_id = user["Id"]
-                favorites = self.client.get_user_favorites(user["Id"])
+
+            def unmark(user):
+                favorites = self.client.get_user_favorites(
+                    user["Id"], fields=self.UNMARK_FIELDS
+                )
                 favorites = [d for d in favorites if d["Type"] in played_item_types]
                 for favorite in favorites:
                     if favorite["UserData"]["Played"]:
-                        self.client.unmark_item_as_favorite(user_id, favorite["Id"])
+                        self.client.unmark_item_as_favorite(user["Id"], favorite["Id"])
+
+            self._fetch_per_user(unmark)
         else:
             raise Exception("Media server type not supported " + self.media_server_type)
 
-    def get_music_items(self):
-        if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            libraries = self.client.get_media_libraries()
-            music_libraries_ids = [
-                d["Id"] for d in libraries if d["CollectionType"] == "music"
-            ]
-
-            music_items = []
-
-            for music_library_id in music_libraries_ids:
-                music_items.extend(
-                    self.client.get_items(
-                        IncludeItemTypes="Audio", ParentId=music_library_id
-                    )
-                )
-
-            unique_ids = set()
-            new_music_items = []
-            for item in music_items:
+    def _iter_library_tracks(self, collection_type):
+        """Yields the unique Audio items of the libraries of the collection type as they are paged in."""
+        libraries = self.client.get_media_libraries()
+        library_ids = [
+            d["Id"] for d in libraries if d["CollectionType"] == collection_type
+        ]
+
+        unique_ids = set()
+        for library_id in library_ids:
+            for item in self.client.iter_items(
+                fields=self.TRACK_FIELDS,
+                IncludeItemTypes="Audio",
+                ParentId=library_id,
+            ):
                 item_id = item["Id"]
                 if item_id in unique_ids:
                     continue
                 unique_ids.add(item_id)
-                new_item = {
+                yield {
                     "title": item["Name"],
                     "id": item_id,
                     "artists": item["Artists"],
                     "album": item["Album"],
                 }
-                new_music_items.append(new_item)
 
-            return new_music_items
+    def iter_music_items(self):
+        if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
+            return self._iter_library_tracks("music")
         else:
             raise Exception("Media server type not supported " + self.media_server_type)
 
-    def get_music_video_items(self):
+    def iter_music_video_items(self):
         if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            libraries = self.client.get_media_libraries()
-            music_video_library_ids = [
-                d["Id"] for d in libraries if d["CollectionType"] == "musicvideos"
-            ]
-
-            music_video_items = []
-
-            for music_library_id in music_video_library_ids:
-                music_video_items.extend(
-                    self.client.get_items(
-                        IncludeItemTypes="Audio", ParentId=music_library_id
-                    )
-                )
-
-            unique_ids = set()
-            new_music_video_items = []
-            for item in music_video_items:
-                item_id = item["Id"]
-                if item_id in unique_ids:
-                    continue
-                unique_ids.add(item_id)
-                new_item = {
-                    "title": item["Name"],
-                    "id": item_id,
-                    "artists": item["Artists"],
-                    "album": item["Album"],
-                }
-                new_music_video_items.append(new_item)
-
-            return new_music_video_items
+            return self._iter_library_tracks("musicvideos")
         else:
             raise Exception("Media server type not supported " + self.media_server_type)
 
+    def get_music_items(self):
+        return list(self.iter_music_items())
+
+    def get_music_video_items(self):
+        return list(self.iter_music_video_items())
+
     def get_playlist_items(self):
         if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
             libraries = self.client.get_media_libraries()
@@ -453,18 +883,22 @@ class MediaServerinteracter:
                 d["Id"] for d in libraries if d["CollectionType"] == "playlists"
             ]
 
-            playlist_items = []
-
-            for user in self.client_users:
-                user_id = user["Id"]
+            def fetch(user):
+                user_items = []
                 for playlist_library_id in playlist_library_ids:
-                    playlist_items.extend(
-                        self.client.get_items(
-                            user_id=user_id,
+                    user_items.extend(
+                        self.client.iter_items(
+                            fields=self.PLAYLIST_FIELDS,
+                            user_id=user["Id"],
                             IncludeItemTypes="Audio",
                             ParentId=playlist_library_id,
                         )
                     )
+                return user_items
+
+            playlist_items = []
+            for _, user_items in self._fetch_per_user(fetch):
+                playlist_items.extend(user_items)
 
             unique_ids = set()
             new_playlist_items = []
@@ -491,7 +925,7 @@ class MediaServerinteracter:
 
     def get_items_from_playlist(self, id):
         if self.media_server_type == "emby" or self.media_server_type == "jellyfin":
-            return self.client.get_playlist_items(id)
+            return self.client.get_playlist_items(id, fields=self.PLAYLIST_FIELDS)
         else:
             raise Exception("Media server type not supported " + self.media_server_type)
 
@@ -6,9 +6,8 @@ import time
 
 import requests
 import yt_dlp
-from sqlalchemy.orm import Session
 
-from database.database import get_program_db
+from database.database import ProgramSessionLocal
 from models.media import musicVideoCache
 from utils.config_manager import ConfigManager
 from utils.log_manager import LoggingManager
@@ -23,7 +22,6 @@ from utils.parsers import make_filename_safe
 config_manager = ConfigManager()
 config = config_manager.get_config()
 logging_manager = LoggingManager()
-db: Session = next(get_program_db())
 
 
 # endregion
@@ -41,18 +39,29 @@ def _cleanup_files(base_path):
 
 
 def _check_cache(title: str, artists: list, album: str = None):
-    existing_data = (
-        db.query(musicVideoCache)
-        .filter_by(title=title, artists=artists, album=album)
-        .first()
-    )
-    if not existing_data:
-        return None
-    if not existing_data.youtubeId and existing_data.dateAdded + 2592000 > time.time():
-        db.delete(existing_data)
+    with ProgramSessionLocal() as db:
+        existing_data = (
+            db.query(musicVideoCache)
+            .filter_by(title=title, artists=artists, album=album)
+            .first()
+        )
+        if not existing_data:
+            return None
+        if (
+            not existing_data.youtubeId
+            and existing_data.dateAdded + 2592000 > time.time()
+        ):
+            db.delete(existing_data)
+            db.commit()
+            return None
+        return existing_data
+
+
+def _save_cache(cache_entry: musicVideoCache):
+    # Sessions are not kept open during the downloads, the entry is merged back afterwards
+    with ProgramSessionLocal() as db:
+        db.merge(cache_entry)
         db.commit()
-        return None
-    return existing_data
 
 
 os.makedirs("./temp/downloading", exist_ok=True)
@@ -171,18 +180,18 @@ def download_music_video(title: str, artists: list, album: str = None):
         try:
             if _download_music_video(existing_data.youtubeId, title, artists, album):
                 existing_data.downloadError = 0
-                db.commit()
+                _save_cache(existing_data)
                 return True
             else:
                 existing_data.downloadError = 1
-                db.commit()
+                _save_cache(existing_data)
                 return False
         except Exception as e:
             logging_manager.log(
                 f"Error downloading music video: {e}", level=logging.ERROR
             )
             existing_data.downloadError = 1
-            db.commit()
+            _save_cache(existing_data)
             return False
 
     if (
@@ -212,28 +221,23 @@ def download_music_video(title: str, artists: list, album: str = None):
     )
 
     if not youtube_id:
-        db.add(db_addition)
-        db.commit()
+        _save_cache(db_addition)
         return False
 
     try:
         if _download_music_video(youtube_id, title, artists, album):
             db_addition.downloadError = 0
-            db.add(db_addition)
-            db.commit()
+            _save_cache(db_addition)
             return True
         else:
             db_addition.downloadError = 1
-            db.add(db_addition)
-            db.commit()
+            _save_cache(db_addition)
             return False
     except Exception as e:
         logging_manager.log(f"Error downloading music video: {e}", level=logging.ERROR)
         db_addition.downloadError = 1
-        db.add(db_addition)
-        db.commit()
+        _save_cache(db_addition)
         return False
 
-    db.add(db_addition)
-    db.commit()
+    _save_cache(db_addition)
     return False
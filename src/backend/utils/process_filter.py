@@ -1,4 +1,26 @@
-from typing import Any, Dict, List
+import operator
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Below this many items the classifier evaluates item by item, building columns costs more
+COLUMNAR_MIN_ITEMS = 1000
+
+# Array versions of the numeric operators, see _parse_numeric_condition
+COLUMN_OPERATORS = {
+    "><": lambda column, min_val, max_val: (min_val < column) & (column < max_val),
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+    "!=": operator.ne,
+    "==": operator.eq,
+}
+# Raw values that are numbers or missing, such columns are converted without normalizing
+NUMBER_TYPES = {int, float, bool, type(None)}
 
 
 def _evaluate_numeric_condition(value: float, condition: str) -> bool:
@@ -20,70 +42,303 @@ def _evaluate_numeric_condition(value: float, condition: str) -> bool:
     return False
 
 
-def _evaluate_string_condition(value: str, condition: str) -> bool:
-    condition = condition.casefold().strip()
-    value = value.casefold().strip()
+def _parse_numeric_condition(condition: str) -> Optional[Tuple[str, Tuple[float, ...]]]:
+    """
+    Returns the operator and bounds of a numeric condition, checked in the order of
+    _evaluate_numeric_condition, or None if it has no operator.
+    Raises ValueError if the bounds are no numbers.
+    """
+    if "><" in condition:
+        min_val, max_val = map(float, condition.split("><"))
+        return "><", (min_val, max_val)
+    for operator in (">=", "<=", ">", "<", "!=", "=="):
+        if operator in condition:
+            return operator, (float(condition[len(operator) :]),)
+    return None
 
-    def parse_condition(condition: str) -> bool:
-        if "&&" in condition:
-            parts = condition.split("&&")
-            return all(parse_condition(part) for part in parts)
-        elif "||" in condition:
-            parts = condition.split("||")
-            return any(parse_condition(part) for part in parts)
-        elif "!" in condition:
-            part = condition[1:]
-            return part not in value
-        else:
-            return condition in value
 
-    return parse_condition(condition)
+def _compile_numeric_condition(condition: str) -> Callable[[float], bool]:
+    """Parses the bounds of a numeric condition once, same operators as _evaluate_numeric_condition."""
+    try:
+        parsed = _parse_numeric_condition(condition)
+    except ValueError:
+        # A string condition on a numeric field fails when it is evaluated, as it always did
+        return lambda value: _evaluate_numeric_condition(value, condition)
+    if parsed is None:
+        return lambda value: False
 
+    operator, bounds = parsed
+    if operator == "><":
+        min_val, max_val = bounds
+        return lambda value: min_val < value < max_val
+    # Bound comparison methods of the parsed float, e.g. value >= bound is bound <= value
+    bound = bounds[0]
+    return {
+        ">=": bound.__le__,
+        "<=": bound.__ge__,
+        ">": bound.__lt__,
+        "<": bound.__gt__,
+        "!=": bound.__ne__,
+        "==": bound.__eq__,
+    }[operator]
 
-def _evaluate_condition(value: Any, condition: str) -> bool:
-    if isinstance(value, (int, float)):
-        return _evaluate_numeric_condition(float(value), condition)
-    elif isinstance(value, str):
-        return _evaluate_string_condition(value, condition)
-    return False
+
+def _compile_string_condition(condition: str) -> Callable[[str], bool]:
+    """
+    Turns a string condition into a predicate on the casefolded and stripped value.
+    "&&" binds weaker than "||", "!" negates a term.
+    """
+    if "&&" in condition:
+        parts = [_compile_string_condition(part) for part in condition.split("&&")]
+        return lambda value: all(part(value) for part in parts)
+    elif "||" in condition:
+        parts = [_compile_string_condition(part) for part in condition.split("||")]
+        return lambda value: any(part(value) for part in parts)
+    elif "!" in condition:
+        term = condition[1:]
+        return lambda value: term not in value
+    return lambda value: condition in value
 
 
-def _get_value_from_path(item: Dict[str, Any], path: str) -> Any:
+def _compile_path(path: str) -> Callable[[Dict[str, Any]], Any]:
     keys = path.split(".")
-    for key in keys:
-        if key not in item:
-            return None
-        item = item[key]
-    return item
+    if len(keys) == 1:
+        # Items are dictionaries, for them get() is the same as the key check below
+        key = keys[0]
+        return lambda item: item.get(key)
 
+    def get_value(item: Dict[str, Any]) -> Any:
+        for key in keys:
+            if key not in item:
+                return None
+            item = item[key]
+        return item
 
-def _process_value(value: Any) -> Any:
+    return get_value
+
+
+def compile_filters(filters: List[Dict[str, str]]) -> Callable[[Dict[str, Any]], bool]:
+    """
+    Compiles the filters into one predicate, so the paths and conditions are parsed once
+    instead of for every item. An item matches when it matches every path of every filter.
+
+    Args:
+        filters: List of {dotted path: condition} dictionaries
+
+    Returns:
+        Callable: Predicate taking an item and returning whether it matches
+    """
+    clauses = [
+        (
+            _compile_path(path),
+            _compile_numeric_condition(condition),
+            _compile_string_condition(condition.casefold().strip()),
+        )
+        for filter_criteria in filters
+        for path, condition in filter_criteria.items()
+    ]
+
+    def matches(item: Dict[str, Any]) -> bool:
+        for get_value, numeric_condition, string_condition in clauses:
+            value = get_value(item)
+            if value is None:
+                return False
+            if isinstance(value, list):
+                value = " ".join(map(str, value))
+            if isinstance(value, (int, float)):
+                if not numeric_condition(float(value)):
+                    return False
+            elif isinstance(value, str):
+                if not string_condition(value.casefold().strip()):
+                    return False
+            else:
+                return False
+        return True
+
+    return matches
+
+
+def _normalize_value(value: Any) -> Any:
+    """The value as the conditions compare it, a float, a casefolded and stripped string or None."""
     if isinstance(value, list):
-        return " ".join(map(str, value))
-    return value
+        value = " ".join(map(str, value))
+    if isinstance(value, (int, float)):
+        return float(value)
+    elif isinstance(value, str):
+        return value.casefold().strip()
+    return None
 
 
-def filter_items(
-    items: List[Dict[str, Any]], filters: List[Dict[str, str]]
-) -> List[Dict[str, Any]]:
-    filtered_items = []
+def _build_column(
+    items: List[Dict[str, Any]], rows: Any, get_value: Callable[[Dict[str, Any]], Any]
+) -> Optional[Tuple[Any, Any, Any]]:
+    """
+    Reads the values of one path into a column.
+
+    Args:
+        items: The arr items
+        rows: Indexes of the items to read, None for all items
+        get_value: Getter of the path
+
+    Returns:
+        tuple: The rows, mask of the numbers and the floats with 0.0 for missing values, None if not all values are numbers or missing
+    """
+    if rows is None:
+        raw_values = [get_value(item) for item in items]
+    else:
+        raw_values = [get_value(items[row]) for row in rows]
+    if not set(map(type, raw_values)) <= NUMBER_TYPES:
+        return None
+    is_float = np.array([value is not None for value in raw_values], dtype=bool)
+    floats = np.array(raw_values, dtype=float)
+    floats[~is_float] = 0.0
+    return rows, is_float, floats
 
-    for item in items:
-        match = True
+
+def compile_classifier(
+    filters_by_tier: Dict[str, List[Dict[str, str]]],
+) -> Callable[[List[Dict[str, Any]]], Dict[str, List[Dict[str, Any]]]]:
+    """
+    Compiles the filters of all tiers into one classifier that sorts the items in a single pass.
+    Paths used by several tiers are read and normalized once per item.
+    With NumPy installed and at least COLUMNAR_MIN_ITEMS items, numeric conditions are evaluated
+    as masks on NumPy columns of the items that matched the clauses before, columns of all items
+    are shared by the tiers. String conditions are still evaluated item by item.
+
+    Args:
+        filters_by_tier: Filters per tier, like popular_filters of the settings
+
+    Returns:
+        Callable: Takes the items and returns the matching items per tier, an item can match several tiers
+    """
+    unparsed = object()
+    getters = []
+    path_indexes = {}
+    tiers = []
+    for tier, filters in filters_by_tier.items():
+        clauses = []
         for filter_criteria in filters:
             for path, condition in filter_criteria.items():
-                value = _get_value_from_path(item, path)
-                if value is not None:
-                    value = _process_value(value)
-                if value is None or not _evaluate_condition(value, condition):
-                    match = False
+                if path not in path_indexes:
+                    path_indexes[path] = len(getters)
+                    getters.append(_compile_path(path))
+                try:
+                    numeric_spec = _parse_numeric_condition(condition)
+                except ValueError:
+                    numeric_spec = unparsed
+                clauses.append(
+                    (
+                        path_indexes[path],
+                        _compile_numeric_condition(condition),
+                        _compile_string_condition(condition.casefold().strip()),
+                        numeric_spec,
+                    )
+                )
+        tiers.append((tier, clauses))
+
+    unread = object()
+
+    def classify_items(items: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        classified = {tier: [] for tier, _ in tiers}
+        tier_lists = [(clauses, classified[tier]) for tier, clauses in tiers]
+        for item in items:
+            values = [unread] * len(getters)
+            for clauses, tier_items in tier_lists:
+                for index, numeric_condition, string_condition, _ in clauses:
+                    value = values[index]
+                    if value is unread:
+                        value = values[index] = _normalize_value(getters[index](item))
+                    if value is None:
+                        break
+                    if value.__class__ is float:
+                        if not numeric_condition(value):
+                            break
+                    elif not string_condition(value):
+                        break
+                else:
+                    tier_items.append(item)
+        return classified
+
+    def classify_columns(
+        items: List[Dict[str, Any]],
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        columns = [unread] * len(getters)
+        values = [None] * len(getters)
+        classified = {}
+        for tier, clauses in tiers:
+            alive = np.ones(len(items), dtype=bool)
+            for index, numeric_condition, string_condition, numeric_spec in clauses:
+                column = None
+                if numeric_spec is not None and numeric_spec is not unparsed:
+                    column = columns[index]
+                    if column is unread:
+                        rows = np.flatnonzero(alive)
+                        if len(rows) == len(items):
+                            rows = None
+                        column = _build_column(items, rows, getters[index])
+                        # Columns of all items are kept for the other tiers
+                        if rows is None:
+                            columns[index] = column
+
+                if column is not None:
+                    rows, is_float, floats = column
+                    operator_name, bounds = numeric_spec
+                    matched = is_float & COLUMN_OPERATORS[operator_name](
+                        floats, *bounds
+                    )
+                    if rows is None:
+                        alive &= matched
+                    else:
+                        alive[rows] = matched
+                else:
+                    # Strings and other values, only for the items that matched so far
+                    if values[index] is None:
+                        values[index] = [unread] * len(items)
+                    path_values = values[index]
+                    for row in np.flatnonzero(alive):
+                        value = path_values[row]
+                        if value is unread:
+                            value = path_values[row] = _normalize_value(
+                                getters[index](items[row])
+                            )
+                        if value is None:
+                            alive[row] = False
+                        elif value.__class__ is float:
+                            alive[row] = numeric_condition(value)
+                        else:
+                            alive[row] = string_condition(value)
+                if not alive.any():
                     break
-            if not match:
-                break
-        if match:
-            filtered_items.append(item)
+            classified[tier] = [items[row] for row in np.flatnonzero(alive)]
+        return classified
+
+    def classify(items: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        if np is None or len(items) < COLUMNAR_MIN_ITEMS:
+            return classify_items(items)
+        try:
+            return classify_columns(items)
+        except (TypeError, OverflowError):
+            # Reading every path of every item can fail on items the per item evaluation
+            # never reaches, like a path through a number
+            return classify_items(items)
+
+    return classify
+
+
+def filter_items(
+    items: List[Dict[str, Any]],
+    filters: Union[List[Dict[str, str]], Callable[[Dict[str, Any]], bool]],
+) -> List[Dict[str, Any]]:
+    """
+    Args:
+        items: The arr items
+        filters: The filters, or the predicate compile_filters made of them
 
-    return filtered_items
+    Returns:
+        list: The items matching the filters
+    """
+    matches = filters if callable(filters) else compile_filters(filters)
+    return [item for item in items if matches(item)]
 
 
 # Example filters:
@@ -0,0 +1,153 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from database.database import ProgramSessionLocal
+from models.workers import WorkerRuns
+
+# Days the history of worker runs is kept
+RUN_HISTORY_DAYS = 30
+
+# Run id and phase timings of the worker run executing in this process
+current_run_id = None
+_phases = {}
+_phase_stack = []
+
+
+def start_run(worker: str) -> int:
+    """Creates the history row of a worker run and returns its id."""
+    with ProgramSessionLocal() as db:
+        run = WorkerRuns(worker=worker, startTime=time.time(), outcome="running")
+        db.add(run)
+        db.commit()
+        return run.id
+
+
+def finish_run(run_id: int, outcome: str):
+    """
+    Stores the end time and outcome of a worker run, phases are written by the run itself.
+    Runs older than RUN_HISTORY_DAYS are deleted, so the history does not grow forever.
+    """
+    with ProgramSessionLocal() as db:
+        run = db.get(WorkerRuns, run_id)
+        if not run:
+            return
+        run.endTime = time.time()
+        run.outcome = outcome
+        db.query(WorkerRuns).filter(
+            WorkerRuns.startTime < run.endTime - RUN_HISTORY_DAYS * 24 * 60 * 60
+        ).delete()
+        db.commit()
+
+
+def set_current_run(run_id: Optional[int]):
+    global current_run_id
+    current_run_id = run_id
+    _phases.clear()
+    _phase_stack.clear()
+
+
+def _save_phases():
+    if current_run_id is None:
+        return
+    with ProgramSessionLocal() as db:
+        run = db.get(WorkerRuns, current_run_id)
+        if not run:
+            return
+        run.phases = {name: round(seconds, 4) for name, seconds in _phases.items()}
+        db.commit()
+
+
+@contextmanager
+def run_phase(name: str):
+    """
+    Times a phase of the current worker run.
+
+    Nested phases pause the phase around them, so every phase only counts its own time.
+    Entering the same phase multiple times adds up the durations. Timings are stored
+    when the outermost phase ends, so a killed run still shows where it got stuck.
+    """
+    now = time.perf_counter()
+    if _phase_stack:
+        outer_name, outer_start = _phase_stack[-1]
+        _phases[outer_name] = _phases.get(outer_name, 0.0) + now - outer_start
+    _phase_stack.append([name, now])
+
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        _, started = _phase_stack.pop()
+        _phases[name] = _phases.get(name, 0.0) + now - started
+        if _phase_stack:
+            _phase_stack[-1][1] = now
+        else:
+            _save_phases()
+
+
+def _percentile(values: List[float], percentile: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * percentile / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return round(values[lower] + (values[upper] - values[lower]) * (index - lower), 4)
+
+
+def get_run_statistics(
+    worker: Optional[str] = None,
+    limit: int = 500,
+    percentiles: tuple = (50, 90, 99),
+) -> Dict[str, dict]:
+    """
+    Calculates duration percentiles of the latest finished runs per worker.
+
+    Args:
+        worker: Only return statistics for this worker
+        limit: Amount of latest runs per worker to use
+        percentiles: Percentiles to calculate
+
+    Returns:
+        dict: Per worker the outcomes, total duration and per phase duration percentiles
+    """
+    statistics = {}
+    with ProgramSessionLocal() as db:
+        worker_names = (
+            [worker]
+            if worker
+            else [row[0] for row in db.query(WorkerRuns.worker).distinct().all()]
+        )
+        for worker_name in worker_names:
+            runs = (
+                db.query(WorkerRuns)
+                .filter(WorkerRuns.worker == worker_name)
+                .filter(WorkerRuns.endTime.isnot(None))
+                .order_by(WorkerRuns.startTime.desc())
+                .limit(limit)
+                .all()
+            )
+            if not runs:
+                continue
+
+            outcomes = {}
+            durations = []
+            phase_durations = {}
+            for run in runs:
+                outcomes[run.outcome] = outcomes.get(run.outcome, 0) + 1
+                durations.append(run.endTime - run.startTime)
+                for phase, seconds in (run.phases or {}).items():
+                    phase_durations.setdefault(phase, []).append(seconds)
+
+            statistics[worker_name] = {
+                "runs": len(runs),
+                "outcomes": outcomes,
+                "last_run": runs[0].startTime,
+                "duration": {f"p{p}": _percentile(durations, p) for p in percentiles},
+                "phases": {
+                    phase: {f"p{p}": _percentile(values, p) for p in percentiles}
+                    for phase, values in phase_durations.items()
+                },
+            }
+
+    return statistics
@@ -0,0 +1,119 @@
+import os
+import socket
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import case, delete, or_, update
+from sqlalchemy.dialects.sqlite import insert
+
+from database.database import ProgramSessionLocal
+from models.workers import ForwardedRuns, WorkerLeases
+
+# Identifies this replica when several arr-tools containers share one database
+replica_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# Lease of the worker run executing in this process as (worker, owner, token)
+current_lease = None
+
+
+def acquire_lease(worker: str, ttl: float) -> Optional[int]:
+    """
+    Takes the lease of a worker if it is free, expired or already held by this replica.
+    The fencing token only increases when the lease changes owner.
+
+    Returns:
+        int: The fencing token of the lease, None if another replica holds it
+    """
+    now = time.time()
+    with ProgramSessionLocal() as db:
+        db.execute(
+            insert(WorkerLeases)
+            .values(worker=worker, owner=None, token=0, expires=0)
+            .on_conflict_do_nothing(index_elements=["worker"])
+        )
+        token = db.execute(
+            update(WorkerLeases)
+            .where(WorkerLeases.worker == worker)
+            .where(or_(WorkerLeases.expires < now, WorkerLeases.owner == replica_id))
+            .values(
+                owner=replica_id,
+                token=case(
+                    (WorkerLeases.owner == replica_id, WorkerLeases.token),
+                    else_=WorkerLeases.token + 1,
+                ),
+                expires=now + ttl,
+            )
+            .returning(WorkerLeases.token)
+        ).scalar()
+        db.commit()
+        return token
+
+
+def renew_lease(worker: str, token: int, ttl: float) -> bool:
+    """Heartbeat of the lease, returns False if another replica took it over."""
+    with ProgramSessionLocal() as db:
+        result = db.execute(
+            update(WorkerLeases)
+            .where(WorkerLeases.worker == worker)
+            .where(WorkerLeases.owner == replica_id)
+            .where(WorkerLeases.token == token)
+            .values(expires=time.time() + ttl)
+        )
+        db.commit()
+        return result.rowcount == 1
+
+
+def release_lease(worker: str, token: int):
+    with ProgramSessionLocal() as db:
+        db.execute(
+            update(WorkerLeases)
+            .where(WorkerLeases.worker == worker)
+            .where(WorkerLeases.owner == replica_id)
+            .where(WorkerLeases.token == token)
+            .values(expires=0)
+        )
+        db.commit()
+
+
+def forward_run(worker: str, kwargs: Dict[str, Any]):
+    """Stores a triggered run for the replica holding the lease of the worker."""
+    with ProgramSessionLocal() as db:
+        db.add(ForwardedRuns(worker=worker, kwargs=kwargs))
+        db.commit()
+
+
+def take_forwarded_runs(worker: str) -> List[Dict[str, Any]]:
+    """Removes and returns the kwargs of the runs other replicas forwarded for the worker."""
+    with ProgramSessionLocal() as db:
+        forwarded = db.execute(
+            delete(ForwardedRuns)
+            .where(ForwardedRuns.worker == worker)
+            .returning(ForwardedRuns.id, ForwardedRuns.kwargs)
+        ).all()
+        db.commit()
+        return [kwargs for _, kwargs in sorted(forwarded)]
+
+
+def set_current_lease(worker: str, owner: str, token: Optional[int]):
+    global current_lease
+    current_lease = (worker, owner, token) if token is not None else None
+
+
+def holds_lease() -> bool:
+    """
+    Checks the fencing token of the current run before it changes anything.
+    Runs without a lease, like dry runs from the API, always hold it.
+    """
+    if current_lease is None:
+        return True
+
+    worker, owner, token = current_lease
+    with ProgramSessionLocal() as db:
+        lease = db.get(WorkerLeases, worker)
+        return (
+            lease is not None
+            and lease.owner == owner
+            and lease.token == token
+            and lease.expires >= time.time()
+        )
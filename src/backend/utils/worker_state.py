@@ -0,0 +1,19 @@
+from typing import Any
+
+from database.database import ProgramSessionLocal
+from models.workers import WorkerState
+
+
+def load_worker_state(key: str, default: Any = None) -> Any:
+    """
+    Returns the state stored under the key, JSON decoded so dictionary keys are strings.
+    """
+    with ProgramSessionLocal() as db:
+        state = db.get(WorkerState, key)
+        return state.value if state is not None else default
+
+
+def save_worker_state(key: str, value: Any):
+    with ProgramSessionLocal() as db:
+        db.merge(WorkerState(key=key, value=value))
+        db.commit()
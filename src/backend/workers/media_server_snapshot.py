@@ -0,0 +1,31 @@
+from typing import Dict, Optional
+
+from utils.config_manager import ConfigManager
+from utils.media_server_interaction import MediaServerinteracter
+from utils.run_history import run_phase
+
+
+def run() -> Optional[Dict[str, int]]:
+    """
+    Takes one snapshot of the media server state for the Radarr and Sonarr workers of this cycle.
+
+    Returns:
+        dict: The snapshot version to hand to the next stages, None if there is nothing to run
+    """
+    config = ConfigManager().get_config()
+    if not config.RADARR.enabled and not config.SONARR.enabled:
+        print("Radarr and Sonarr disabled, not taking a media server snapshot")
+        return None
+
+    with run_phase("fetch_media_server"):
+        media_server = MediaServerinteracter(
+            config.MEDIASERVER.media_server_type,
+            config.MEDIASERVER.media_server_base_url,
+            config.MEDIASERVER.media_server_api_key,
+            config.MEDIASERVER.max_concurrent_requests,
+        )
+        snapshot_version = media_server.update_snapshot()
+
+    print(f"Took media server snapshot {snapshot_version}")
+    print(f"Media server connections: {media_server.get_connection_stats()}")
+    return {"snapshot_version": snapshot_version}
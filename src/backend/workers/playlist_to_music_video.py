@@ -18,6 +18,7 @@ media_server = MediaServerinteracter(
     config.MEDIASERVER.media_server_type,
     config.MEDIASERVER.media_server_base_url,
     config.MEDIASERVER.media_server_api_key,
+    config.MEDIASERVER.max_concurrent_requests,
 )
 
 
@@ -126,7 +127,7 @@ def index_tracks_by_title(media_server_tracks):
 
 def main():
     media_server_video_tracks_by_title = index_tracks_by_title(
-        media_server.get_music_video_items()
+        media_server.iter_music_video_items()
     )
 
     existing_server_playlists = media_server.get_playlist_items()
@@ -155,6 +156,7 @@ def run():
         config.MEDIASERVER.media_server_type,
         config.MEDIASERVER.media_server_base_url,
         config.MEDIASERVER.media_server_api_key,
+        config.MEDIASERVER.max_concurrent_requests,
     )
 
     main()
@@ -4,20 +4,23 @@ import time
 from typing import Dict, List, Set, Tuple, Any, Optional
 
 from pyarr import RadarrAPI
-from sqlalchemy.orm import Session
 
-from database.database import get_program_db
+from utils.arr_mirror import ArrMirror, invalidate_arr_items
 from utils.config_manager import ConfigManager
 from utils.general_arr_actions import (
     reassign_based_on_age,
-    link_arr_to_media_server,
+    ArrMatcher,
+    select_targeted_items,
     classify_items_by_decay,
     combine_tuples,
     sort_tuples,
     subtract_dicts,
 )
 from utils.media_server_interaction import MediaServerinteracter
-from utils.process_filter import filter_items
+from utils.process_filter import compile_classifier
+from utils.run_history import run_phase
+from utils.worker_lease import holds_lease
+from utils.worker_state import load_worker_state, save_worker_state
 
 # Initialize global variables
 config = ConfigManager().get_config()
@@ -25,14 +28,17 @@ media_server = MediaServerinteracter(
     config.MEDIASERVER.media_server_type,
     config.MEDIASERVER.media_server_base_url,
     config.MEDIASERVER.media_server_api_key,
+    config.MEDIASERVER.max_concurrent_requests,
 )
 radarr = None
-db: Session = next(get_program_db())
 
 # Cache for movie data to improve performance
 movie_cache = {}
-# Search history with timestamps for cooldown implementation
+# Search history with timestamps for cooldown implementation, loaded from the
+# worker state for the searches of a run as every run is a new process
 search_history = {}
+# Seconds a search counts for the cooldown
+SEARCH_COOLDOWN = 3000
 
 
 class RadarrManager:
@@ -44,6 +50,8 @@ class RadarrManager:
         self.config = ConfigManager().get_config()
         self.now_time = datetime.datetime.now(datetime.timezone.utc)
         self.arr_items = []
+        # Index of arr_items to link media server items, set together with arr_items
+        self.arr_matcher = ArrMatcher([])
         self.exclude_tags_from_monitoring = set(
             self.config.RADARR.exclude_tags_from_monitoring
         )
@@ -53,6 +61,23 @@ class RadarrManager:
         self.exclude_tags_from_deletion = set(
             self.config.RADARR.exclude_tags_from_deletion
         )
+        # Popularity filters of all tiers, parsed once for the run
+        self.classify_popularity = compile_classifier(
+            self.config.RADARR.popular_filters
+        )
+        # arr_items per popularity tier, see get_popularity_tiers
+        self.popularity_tiers = None
+
+    def get_popularity_tiers(self) -> Dict[str, List[Dict]]:
+        """
+        Sorts arr_items into the popularity tiers in one pass the first time it is called in a run.
+
+        Returns:
+            dict: The movies per tier, new lists every call as the callers move items between them
+        """
+        if self.popularity_tiers is None:
+            self.popularity_tiers = self.classify_popularity(self.arr_items)
+        return {tier: list(items) for tier, items in self.popularity_tiers.items()}
 
     def get_quality_changes(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
         """
@@ -68,34 +93,38 @@ class RadarrManager:
         favorited_items = []
         on_resume_items = []
 
-        if self.config.RADARR.use_watched:
-            watched_items = media_server.get_played(
-                ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades
-            )["Movies"]
-        if self.config.RADARR.use_favorite:
-            favorited_items = media_server.get_all_favorites(
-                ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades
-            )["Movies"]
-        if self.config.RADARR.use_on_resume:
-            on_resume_items = media_server.get_on_resume(
-                ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades
-            )["Movies"]
+        with run_phase("fetch_media_server"):
+            if self.config.RADARR.use_watched:
+                watched_items = media_server.get_played(
+                    ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades,
+                    refresh=False,
+                )["Movies"]
+            if self.config.RADARR.use_favorite:
+                favorited_items = media_server.get_all_favorites(
+                    ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades,
+                    refresh=False,
+                )["Movies"]
+            if self.config.RADARR.use_on_resume:
+                on_resume_items = media_server.get_on_resume(
+                    ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades,
+                    refresh=False,
+                )["Movies"]
 
         # Convert media server format to arr format
         watched_items = [
             arr_item
             for item in watched_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
         favorited_items = [
             arr_item
             for item in favorited_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
         on_resume_items = [
             arr_item
             for item in on_resume_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
 
         # Here should the decaying of watched items be implemented...
@@ -122,11 +151,11 @@ class RadarrManager:
         )
 
         # region Filters
-        filters = self.config.RADARR.popular_filters
-        very_popular_items = filter_items(self.arr_items, filters["very_popular"])
-        popular_items = filter_items(self.arr_items, filters["popular"])
-        less_popular_items = filter_items(self.arr_items, filters["less_popular"])
-        unpopular_items = filter_items(self.arr_items, filters["unpopular"])
+        tiers = self.get_popularity_tiers()
+        very_popular_items = tiers["very_popular"]
+        popular_items = tiers["popular"]
+        less_popular_items = tiers["less_popular"]
+        unpopular_items = tiers["unpopular"]
         reassign_based_on_age(
             very_popular_items,
             self.config.RADARR.very_popular_decay_days,
@@ -227,47 +256,51 @@ class RadarrManager:
         unpopular_items = []
         unmonitor = []
 
-        watched_items = media_server.get_played(
-            ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades
-        )["Movies"]
-        if (
-            self.config.RADARR.use_favorite
-            and self.config.RADARR.mark_favorited_as_monitored
-        ):
-            favorited_items = media_server.get_all_favorites(
-                ignore_user_ids=self.config.RADARR.exclude_users_from_monitoring
-            )["Movies"]
-        if (
-            self.config.RADARR.use_on_resume
-            and self.config.RADARR.mark_on_resume_as_monitored
-        ):
-            on_resume_items = media_server.get_on_resume(
-                ignore_user_ids=self.config.RADARR.exclude_users_from_monitoring
+        with run_phase("fetch_media_server"):
+            watched_items = media_server.get_played(
+                ignore_user_ids=self.config.RADARR.exclude_users_from_quality_upgrades,
+                refresh=False,
             )["Movies"]
+            if (
+                self.config.RADARR.use_favorite
+                and self.config.RADARR.mark_favorited_as_monitored
+            ):
+                favorited_items = media_server.get_all_favorites(
+                    ignore_user_ids=self.config.RADARR.exclude_users_from_monitoring,
+                    refresh=False,
+                )["Movies"]
+            if (
+                self.config.RADARR.use_on_resume
+                and self.config.RADARR.mark_on_resume_as_monitored
+            ):
+                on_resume_items = media_server.get_on_resume(
+                    ignore_user_ids=self.config.RADARR.exclude_users_from_monitoring,
+                    refresh=False,
+                )["Movies"]
 
         favorited_items = [
             arr_item
             for item in favorited_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
         on_resume_items = [
             arr_item
             for item in on_resume_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
 
-        filters = self.config.RADARR.popular_filters
+        tiers = self.get_popularity_tiers()
         if self.config.RADARR.mark_very_popular_as_monitored:
-            very_popular_items = filter_items(self.arr_items, filters["very_popular"])
+            very_popular_items = tiers["very_popular"]
         if self.config.RADARR.mark_popular_as_monitored:
-            popular_items = filter_items(self.arr_items, filters["popular"])
+            popular_items = tiers["popular"]
         if self.config.RADARR.mark_less_popular_as_monitored:
-            less_popular_items = filter_items(self.arr_items, filters["less_popular"])
+            less_popular_items = tiers["less_popular"]
         if (
             self.config.RADARR.mark_unpopular_as_monitored
             or self.config.RADARR.mark_unpopular_as_unmonitored
         ):
-            unpopular_items = filter_items(self.arr_items, filters["unpopular"])
+            unpopular_items = tiers["unpopular"]
         reassign_based_on_age(
             very_popular_items,
             self.config.RADARR.very_popular_decay_days,
@@ -419,8 +452,9 @@ class RadarrManager:
 
                 # Remove search times older than 50 minutes
                 while (
-                    last_search_times and last_search_times[0] < current_time - 3000
-                ):  # 50 minutes in seconds
+                    last_search_times
+                    and last_search_times[0] < current_time - SEARCH_COOLDOWN
+                ):
                     last_search_times.pop(0)
 
                 # If less than 2 searches in the last 50 minutes, allow search
@@ -490,17 +524,27 @@ def check_if_radarr_is_busy() -> bool:
     )
 
 
-def run(dry: bool = False) -> Optional[Dict[str, Any]]:
+def run(
+    dry: bool = False,
+    snapshot_version: Optional[int] = None,
+    movie_ids: Optional[List[int]] = None,
+    media_server_items: Optional[List[Dict[str, Any]]] = None,
+    media_server_user_ids: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
     """
     Main entry point for the Radarr worker.
 
     Args:
         dry: If True, performs a dry run without making changes
+        snapshot_version: Media server snapshot taken for this cycle, a new one is taken if not given
+        movie_ids: Only re-evaluate these Radarr items, used for events
+        media_server_items: Only re-evaluate the Radarr items matching these media server items, with 'Name' and 'ProviderIds'
+        media_server_user_ids: Media server users of the events, only their data is synced for the run
 
     Returns:
-        dict: Results of the dry run if dry=True, None otherwise
+        dict: Results of the dry run if dry=True, otherwise the amount of changes or None if it did not run
     """
-    global radarr, movie_cache
+    global radarr, movie_cache, search_history
 
     try:
         # Initialize Radarr API
@@ -518,13 +562,51 @@ def run(dry: bool = False) -> Optional[Dict[str, Any]]:
         # Clear cache for fresh data
         movie_cache = {}
 
+        # Use the media server snapshot shared with the other workers of this cycle,
+        # runs for events sync only the users of the events or reuse the latest snapshot
+        targeted = movie_ids is not None or media_server_items is not None
+        # Stages of a cycle have to read the snapshot the cycle took, like the other stages
+        stage_run = snapshot_version is not None
+        if snapshot_version is None:
+            with run_phase("fetch_media_server"):
+                if media_server_user_ids:
+                    snapshot_version = media_server.update_snapshot(
+                        user_ids=media_server_user_ids
+                    )
+                elif targeted:
+                    snapshot_version = media_server.get_snapshot_version()
+                if snapshot_version is None:
+                    snapshot_version = media_server.update_snapshot()
+
         # Initialize manager
         manager = RadarrManager()
-        manager.arr_items = radarr.get_movie()
+        with run_phase("fetch_arr_items"):
+            manager.arr_items = ArrMirror("radarr", radarr).get_items()
 
-        # Get changes
-        quality_changes, monitor, unmonitor = manager.get_quality_changes()
-        monitorable_items, unmonitorable_items = manager.get_monitorable_items()
+        # Only re-evaluate the items events were received for
+        if targeted:
+            manager.arr_items = select_targeted_items(
+                manager.arr_items, movie_ids, media_server_items
+            )
+            if not manager.arr_items:
+                print("No Radarr items found for the events, doing nothing")
+                return None
+
+        manager.arr_matcher = ArrMatcher(manager.arr_items)
+
+        # Get changes, all media server reads come from the same snapshot
+        with run_phase("classify"), media_server.read_snapshot() as read_version:
+            print(f"Reading media server snapshot {read_version}")
+            if stage_run and read_version != snapshot_version:
+                # A sync wrote the media server tables after the cycle's snapshot, the other
+                # stages may have read the older data. Counting it as a change starts the next
+                # cycle at the base interval, where all stages read one snapshot again
+                print(
+                    f"Media server snapshot {snapshot_version} was replaced, Radarr waits for the next cycle"
+                )
+                return {"changes": 1}
+            quality_changes, monitor, unmonitor = manager.get_quality_changes()
+            monitorable_items, unmonitorable_items = manager.get_monitorable_items()
 
         # Combine monitor/unmonitor items
         monitorable_items += monitor
@@ -548,27 +630,62 @@ def run(dry: bool = False) -> Optional[Dict[str, Any]]:
                 "deletable_items": [],
             }
 
+        # Another replica took over while this run was classifying, leave the edits to it
+        if not holds_lease():
+            print("Lost the Radarr worker lease, not applying changes")
+            return None
+
         # Apply changes and collect movie IDs to search
         search_movie_ids = set()
 
-        # Apply quality changes
-        quality_search_ids = manager.change_quality(quality_changes)
-        search_movie_ids.update(quality_search_ids)
-
-        # Apply monitoring changes
-        monitor_search_ids = manager.change_monitoring(monitorable_items, True)
-        search_movie_ids.update(monitor_search_ids)
-        manager.change_monitoring(unmonitorable_items, False)
-
-        # Delete unmonitored files if enabled
-        if config.RADARR.delete_unmonitored_files:
-            delete_unmonitored_files()
+        with run_phase("apply_edits"):
+            # Apply quality changes
+            quality_search_ids = manager.change_quality(quality_changes)
+            search_movie_ids.update(quality_search_ids)
+
+            # Apply monitoring changes
+            monitor_search_ids = manager.change_monitoring(monitorable_items, True)
+            search_movie_ids.update(monitor_search_ids)
+            manager.change_monitoring(unmonitorable_items, False)
+
+            # Delete unmonitored files if enabled
+            if config.RADARR.delete_unmonitored_files and not targeted:
+                delete_unmonitored_files()
+
+            # The next run fetches the edited movies again instead of waiting for a full sync
+            invalidate_arr_items(
+                "radarr",
+                [change["item"]["id"] for change in quality_changes]
+                + [item["id"] for item in monitorable_items + unmonitorable_items],
+            )
 
         # Perform searches with cooldown
-        manager.search_movies_with_cooldown(search_movie_ids)
+        with run_phase("search"):
+            search_history = {
+                int(movie_id): search_times
+                for movie_id, search_times in load_worker_state(
+                    "radarr.search_history", {}
+                ).items()
+            }
+            manager.search_movies_with_cooldown(search_movie_ids)
+            save_worker_state(
+                "radarr.search_history",
+                {
+                    movie_id: search_times
+                    for movie_id, search_times in search_history.items()
+                    if search_times
+                    and search_times[-1] >= time.time() - SEARCH_COOLDOWN
+                },
+            )
 
         print("Ran the Radarr instance")
-        return None
+        print(f"Media server connections: {media_server.get_connection_stats()}")
+        # Lets the scheduler back off while nothing changes
+        return {
+            "changes": len(quality_changes)
+            + len(monitorable_items)
+            + len(unmonitorable_items)
+        }
 
     except Exception as error_message:
         pattern_length_difference = r"pyarr\.exceptions\.PyarrServerError: Internal Server Error: Expected query to return (\d+) rows but returned (\d+)"
@@ -2,23 +2,32 @@ import datetime
 import re
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Set, Tuple, Any, Optional
 
-from sqlalchemy.orm import Session
 
-from database.database import get_program_db
+from utils.arr_mirror import (
+    ArrMirror,
+    invalidate_arr_items,
+    load_cached_episodes,
+    store_episodes,
+)
 from utils.config_manager import ConfigManager
 from utils.customSonarApi import customSonarAPI
 from utils.general_arr_actions import (
     reassign_based_on_age,
-    link_arr_to_media_server,
+    ArrMatcher,
+    select_targeted_items,
     classify_items_by_decay,
     combine_tuples,
     sort_tuples,
     subtract_dicts,
 )
 from utils.media_server_interaction import MediaServerinteracter
-from utils.process_filter import filter_items
+from utils.process_filter import compile_classifier
+from utils.run_history import run_phase
+from utils.worker_lease import holds_lease
+from utils.worker_state import load_worker_state, save_worker_state
 
 # Initialize global variables
 config = ConfigManager().get_config()
@@ -26,16 +35,21 @@ media_server = MediaServerinteracter(
     config.MEDIASERVER.media_server_type,
     config.MEDIASERVER.media_server_base_url,
     config.MEDIASERVER.media_server_api_key,
+    config.MEDIASERVER.max_concurrent_requests,
 )
 sonarr = None
-db: Session = next(get_program_db())
 
-# Cache for series data to improve performance
+# Episodes per series ID, loaded from the episode cache at the start of a run
 series_cache = {}
 # Search history with timestamps for cooldown implementation
 search_history = {}
 # Last time monitored episodes changed for each series
 monitored_episodes_history = {}
+# Both are loaded from the worker state for the edits and searches of a run,
+# as every run is a new process
+
+# Seconds a search counts for the cooldown
+SEARCH_COOLDOWN = 3000
 
 
 class SonarrManager:
@@ -47,6 +61,10 @@ class SonarrManager:
         self.config = ConfigManager().get_config()
         self.now_time = datetime.datetime.now(datetime.timezone.utc)
         self.arr_items = []
+        # Index of arr_items to link media server items, set together with arr_items
+        self.arr_matcher = ArrMatcher([])
+        # Series whose monitoring was written to Sonarr, their mirrored copies are outdated
+        self.edited_series = set()
         self.exclude_tags_from_monitoring = set(
             self.config.SONARR.exclude_tags_from_monitoring
         )
@@ -56,6 +74,23 @@ class SonarrManager:
         self.exclude_tags_from_deletion = set(
             self.config.SONARR.exclude_tags_from_deletion
         )
+        # Popularity filters of all tiers, parsed once for the run
+        self.classify_popularity = compile_classifier(
+            self.config.SONARR.popular_filters
+        )
+        # arr_items per popularity tier, see get_popularity_tiers
+        self.popularity_tiers = None
+
+    def get_popularity_tiers(self) -> Dict[str, List[Dict]]:
+        """
+        Sorts arr_items into the popularity tiers in one pass the first time it is called in a run.
+
+        Returns:
+            dict: The series per tier, new lists every call as the callers move items between them
+        """
+        if self.popularity_tiers is None:
+            self.popularity_tiers = self.classify_popularity(self.arr_items)
+        return {tier: list(items) for tier, items in self.popularity_tiers.items()}
 
     def get_quality_changes(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
         """
@@ -70,20 +105,26 @@ class SonarrManager:
         watched_items = []
         favorited_items = []
 
-        # Get favorited items if enabled
-        if self.config.SONARR.use_favorite:
-            favorited_items = media_server.get_all_favorites(
-                ignore_user_ids=self.config.SONARR.exclude_users_from_quality_upgrades
-            )["Series"]
+        with run_phase("fetch_media_server"):
+            # Get favorited items if enabled
+            if self.config.SONARR.use_favorite:
+                favorited_items = media_server.get_all_favorites(
+                    ignore_user_ids=self.config.SONARR.exclude_users_from_quality_upgrades,
+                    refresh=False,
+                )["Series"]
+
+            # Get watched items if enabled
+            if self.config.SONARR.use_watched:
+                watched_items = media_server.get_played(
+                    ignore_user_ids=self.config.SONARR.exclude_users_from_quality_upgrades,
+                    refresh=False,
+                )["Series"]
+                played_items = media_server.get_played(
+                    ignore_user_ids=self.config.SONARR.exclude_users_from_monitoring,
+                    refresh=False,
+                )
 
-        # Get watched items if enabled
         if self.config.SONARR.use_watched:
-            watched_items = media_server.get_played(
-                ignore_user_ids=self.config.SONARR.exclude_users_from_quality_upgrades
-            )["Series"]
-            played_items = media_server.get_played(
-                ignore_user_ids=self.config.SONARR.exclude_users_from_monitoring
-            )
             watched_items = (
                 played_items["Series"] + played_items["Episodes"] + watched_items
             )
@@ -94,12 +135,12 @@ class SonarrManager:
         watched_items = [
             arr_item
             for item in watched_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
         favorited_items = [
             arr_item
             for item in favorited_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
 
         # Classify items by decay
@@ -119,11 +160,11 @@ class SonarrManager:
         )
 
         # Apply filters
-        filters = self.config.SONARR.popular_filters
-        very_popular_items = filter_items(self.arr_items, filters["very_popular"])
-        popular_items = filter_items(self.arr_items, filters["popular"])
-        less_popular_items = filter_items(self.arr_items, filters["less_popular"])
-        unpopular_items = filter_items(self.arr_items, filters["unpopular"])
+        tiers = self.get_popularity_tiers()
+        very_popular_items = tiers["very_popular"]
+        popular_items = tiers["popular"]
+        less_popular_items = tiers["less_popular"]
+        unpopular_items = tiers["unpopular"]
 
         # Reassign based on age
         reassign_based_on_age(
@@ -314,6 +355,57 @@ class SonarrManager:
 
         return episode_ids
 
+    def _prefetch_episodes(self, series_ids):
+        """
+        Fills series_cache with the episodes of the series, fetching max_concurrent_requests series at a time.
+        Sonarr only returns the episodes of one series per request, so this is one request per uncached series.
+        Series that fail are left out and fetched again by _get_episodes.
+
+        Args:
+            series_ids: IDs of the series to fetch the episodes of
+        """
+        missing_ids = [
+            series_id
+            for series_id in dict.fromkeys(series_ids)
+            if series_id not in series_cache
+        ]
+        if not missing_ids:
+            return
+
+        with run_phase("fetch_arr_items"), ThreadPoolExecutor(
+            max_workers=max(1, self.config.SONARR.max_concurrent_requests)
+        ) as executor:
+            futures = {
+                executor.submit(
+                    sonarr.get_series_episodes,
+                    series_id,
+                    self.config.SONARR.request_timeout,
+                ): series_id
+                for series_id in missing_ids
+            }
+            fetched = {}
+            for future in as_completed(futures):
+                series_id = futures[future]
+                try:
+                    fetched[series_id] = future.result()
+                except Exception as error_message:
+                    print(
+                        f"Failed to fetch the episodes of series {series_id}: {error_message}"
+                    )
+
+        series_cache.update(fetched)
+        store_episodes(self.arr_items, fetched)
+
+    def _get_episodes(self, series_id):
+        """Returns the episodes of the series from series_cache, fetching them if missing."""
+        if series_id not in series_cache:
+            with run_phase("fetch_arr_items"):
+                series_cache[series_id] = sonarr.get_series_episodes(
+                    series_id, self.config.SONARR.request_timeout
+                )
+            store_episodes(self.arr_items, {series_id: series_cache[series_id]})
+        return series_cache[series_id]
+
     def get_monitorable_items(self):
         """
         Identifies items to monitor/unmonitor.
@@ -329,48 +421,57 @@ class SonarrManager:
         unpopular_items = []
         unmonitor = []
 
-        # Get favorited items if enabled
-        if (
-            self.config.SONARR.use_favorite
-            and self.config.SONARR.mark_favorited_as_monitored
-        ):
-            favorited_items = media_server.get_all_favorites(
-                ignore_user_ids=self.config.SONARR.exclude_users_from_monitoring
-            )["Series"]
+        with run_phase("fetch_media_server"):
+            # Get favorited items if enabled
+            if (
+                self.config.SONARR.use_favorite
+                and self.config.SONARR.mark_favorited_as_monitored
+            ):
+                favorited_items = media_server.get_all_favorites(
+                    ignore_user_ids=self.config.SONARR.exclude_users_from_monitoring,
+                    refresh=False,
+                )["Series"]
 
-        # Get played items
-        played_items = media_server.get_played(
-            ignore_user_ids=self.config.SONARR.exclude_users_from_monitoring
-        )
-        played_series = played_items["Series"] + played_items["Episodes"]
-        temp = {item["Name"] for item in played_series}
-        played_series = [{"Name": item} for item in temp]
+            # Get played items
+            played_items = media_server.get_played(
+                ignore_user_ids=self.config.SONARR.exclude_users_from_monitoring,
+                refresh=False,
+            )
+        # One entry per series name, keeping the provider IDs of the played series
+        played_by_name = {}
+        for item in played_items["Series"] + played_items["Episodes"]:
+            if item.get("ProviderIds") or item["Name"] not in played_by_name:
+                played_by_name[item["Name"]] = {
+                    "Name": item["Name"],
+                    "ProviderIds": item.get("ProviderIds", {}),
+                }
+        played_series = list(played_by_name.values())
 
         # Convert media server format to arr format
         favorited_items = [
             arr_item
             for item in favorited_items
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
         played_series = [
             arr_item
             for item in played_series
-            if (arr_item := link_arr_to_media_server(item, self.arr_items)) is not None
+            if (arr_item := self.arr_matcher.match(item)) is not None
         ]
 
         # Apply filters
-        filters = self.config.SONARR.popular_filters
+        tiers = self.get_popularity_tiers()
         if self.config.SONARR.mark_very_popular_as_monitored:
-            very_popular_items = filter_items(self.arr_items, filters["very_popular"])
+            very_popular_items = tiers["very_popular"]
         if self.config.SONARR.mark_popular_as_monitored:
-            popular_items = filter_items(self.arr_items, filters["popular"])
+            popular_items = tiers["popular"]
         if self.config.SONARR.mark_less_popular_as_monitored:
-            less_popular_items = filter_items(self.arr_items, filters["less_popular"])
+            less_popular_items = tiers["less_popular"]
         if (
             self.config.SONARR.mark_unpopular_as_monitored
             or self.config.SONARR.mark_unpopular_as_unmonitored
         ):
-            unpopular_items = filter_items(self.arr_items, filters["unpopular"])
+            unpopular_items = tiers["unpopular"]
 
         # Reassign based on age
         reassign_based_on_age(
@@ -437,8 +538,11 @@ class SonarrManager:
         max_played_episodes = []
         max_played_episodes_shows = []
 
-        for item in media_server.get_max_played_episodes():
-            arr_item = link_arr_to_media_server(item, self.arr_items)
+        with run_phase("fetch_media_server"):
+            max_played = media_server.get_max_played_episodes(refresh=False)
+
+        for item in max_played:
+            arr_item = self.arr_matcher.match(item)
             if not arr_item:
                 continue
             max_played_episodes.append(item)
@@ -446,6 +550,13 @@ class SonarrManager:
 
         monitor_episodes = []
 
+        # Both loops below read the episodes of every series without an excluded tag
+        self._prefetch_episodes(
+            arr_item["id"]
+            for arr_item in max_played_episodes_shows + self.arr_items
+            if not self.exclude_tags_from_monitoring & set(arr_item["tags"])
+        )
+
         for idx in range(len(max_played_episodes)):
             if not max_played_episodes_shows[idx]:
                 continue
@@ -456,12 +567,7 @@ class SonarrManager:
 
             series_id = max_played_episodes_shows[idx]["id"]
 
-            # Use cache if available
-            if series_id in series_cache:
-                episodes_data = series_cache[series_id]
-            else:
-                episodes_data = sonarr.get_episode(series_id, series=True)
-                series_cache[series_id] = episodes_data
+            episodes_data = self._get_episodes(series_id)
 
             # Check for missing files that need to be rechecked
             for episode in episodes_data:
@@ -569,12 +675,7 @@ class SonarrManager:
 
             series_id = arr_item["id"]
 
-            # Use cache if available
-            if series_id in series_cache:
-                episodes_data = series_cache[series_id]
-            else:
-                episodes_data = sonarr.get_episode(series_id, series=True)
-                series_cache[series_id] = episodes_data
+            episodes_data = self._get_episodes(series_id)
 
             for episode in episodes_data:
                 episode_id = episode["id"]
@@ -707,6 +808,7 @@ class SonarrManager:
             sonarr.upd_series_editor(
                 {"monitored": monitor, "seriesIds": list(allowed_changes)}
             )
+            self.edited_series.update(allowed_changes)
 
         # Return series IDs to search if monitoring
         return allowed_changes if monitor else set()
@@ -733,12 +835,19 @@ class SonarrManager:
                     continue
                 seasons_monitoring[item["series_id"]].add(item["season_number"])
 
+            mirrored_series = {item["id"]: item for item in self.arr_items}
             for serie_id, seasons in seasons_monitoring.items():
-                found_series = next(
-                    (item for item in self.arr_items if item["id"] == serie_id), None
-                )
-                if not found_series:
+                mirrored = mirrored_series.get(serie_id)
+                if mirrored is None:
+                    continue
+                # Only series with an unmonitored season to change are fetched and written
+                if not any(
+                    not season["monitored"] and season["seasonNumber"] in seasons
+                    for season in mirrored.get("seasons", [])
+                ):
                     continue
+                # The whole series is written back, so edit the current one and not the mirrored copy
+                found_series = sonarr.get_series(serie_id)
 
                 changed_season = False
                 for season in found_series["seasons"]:
@@ -750,6 +859,7 @@ class SonarrManager:
 
                 if changed_season:
                     sonarr.upd_series(found_series)
+                    self.edited_series.add(serie_id)
 
         # Update episode monitoring
         allowed_changes = set()
@@ -764,6 +874,7 @@ class SonarrManager:
 
         if allowed_changes:
             sonarr.upd_episode_monitor(list(allowed_changes), monitor)
+            self.edited_series.update(search_series)
 
             # Track monitored episodes changes for cooldown override
             if monitor:
@@ -801,8 +912,9 @@ class SonarrManager:
 
                 # Remove search times older than 50 minutes
                 while (
-                    last_search_times and last_search_times[0] < current_time - 3000
-                ):  # 50 minutes in seconds
+                    last_search_times
+                    and last_search_times[0] < current_time - SEARCH_COOLDOWN
+                ):
                     last_search_times.pop(0)
 
                 # If less than 2 searches in the last 50 minutes, allow search
@@ -863,17 +975,27 @@ def delete_unmonitored_files(dry: bool = False, delete: list = ["episode"]):
     return list(deletions_done)
 
 
-def run(dry: bool = False):
+def run(
+    dry: bool = False,
+    snapshot_version: Optional[int] = None,
+    series_ids: Optional[List[int]] = None,
+    media_server_items: Optional[List[Dict[str, Any]]] = None,
+    media_server_user_ids: Optional[List[str]] = None,
+):
     """
     Main entry point for the Sonarr worker.
 
     Args:
         dry: If True, performs a dry run without making changes
+        snapshot_version: Media server snapshot taken for this cycle, a new one is taken if not given
+        series_ids: Only re-evaluate these Sonarr items, used for events
+        media_server_items: Only re-evaluate the Sonarr items matching these media server items, with 'Name' and 'ProviderIds'
+        media_server_user_ids: Media server users of the events, only their data is synced for the run
 
     Returns:
-        dict: Results of the dry run if dry=True, None otherwise
+        dict: Results of the dry run if dry=True, otherwise the amount of changes or None if it did not run
     """
-    global sonarr, series_cache
+    global sonarr, series_cache, search_history, monitored_episodes_history
 
     try:
         # Initialize Sonarr API
@@ -888,22 +1010,60 @@ def run(dry: bool = False):
             print("Sonarr is busy, doing nothing")
             return
 
-        # Clear cache for fresh data
-        series_cache = {}
+        # Use the media server snapshot shared with the other workers of this cycle,
+        # runs for events sync only the users of the events or reuse the latest snapshot
+        targeted = series_ids is not None or media_server_items is not None
+        # Stages of a cycle have to read the snapshot the cycle took, like the other stages
+        stage_run = snapshot_version is not None
+        if snapshot_version is None:
+            with run_phase("fetch_media_server"):
+                if media_server_user_ids:
+                    snapshot_version = media_server.update_snapshot(
+                        user_ids=media_server_user_ids
+                    )
+                elif targeted:
+                    snapshot_version = media_server.get_snapshot_version()
+                if snapshot_version is None:
+                    snapshot_version = media_server.update_snapshot()
 
         # Initialize manager
         manager = SonarrManager()
-        manager.arr_items = sonarr.get_series()
+        with run_phase("fetch_arr_items"):
+            manager.arr_items = ArrMirror("sonarr", sonarr).get_items()
 
-        # Get changes
-        quality_changes, monitor, unmonitor = manager.get_quality_changes()
-        (
-            monitorable_items,
-            unmonitorable_items,
-            monitor_episodes,
-            unmonitor_episodes,
-            recheck_releases,
-        ) = manager.get_monitorable_items()
+        # Only re-evaluate the items events were received for
+        if targeted:
+            manager.arr_items = select_targeted_items(
+                manager.arr_items, series_ids, media_server_items
+            )
+            if not manager.arr_items:
+                print("No Sonarr items found for the events, doing nothing")
+                return None
+
+        manager.arr_matcher = ArrMatcher(manager.arr_items)
+
+        # Only the episodes of series that changed since they were cached are fetched again
+        series_cache = load_cached_episodes(manager.arr_items)
+
+        # Get changes, all media server reads come from the same snapshot
+        with run_phase("classify"), media_server.read_snapshot() as read_version:
+            print(f"Reading media server snapshot {read_version}")
+            if stage_run and read_version != snapshot_version:
+                # A sync wrote the media server tables after the cycle's snapshot, the other
+                # stages may have read the older data. Counting it as a change starts the next
+                # cycle at the base interval, where all stages read one snapshot again
+                print(
+                    f"Media server snapshot {snapshot_version} was replaced, Sonarr waits for the next cycle"
+                )
+                return {"changes": 1}
+            quality_changes, monitor, unmonitor = manager.get_quality_changes()
+            (
+                monitorable_items,
+                unmonitorable_items,
+                monitor_episodes,
+                unmonitor_episodes,
+                recheck_releases,
+            ) = manager.get_monitorable_items()
 
         # Combine monitor/unmonitor items
         monitorable_items += monitor
@@ -929,35 +1089,86 @@ def run(dry: bool = False):
                 "deletable_items": [],
             }
 
+        # Another replica took over while this run was classifying, leave the edits to it
+        if not holds_lease():
+            print("Lost the Sonarr worker lease, not applying changes")
+            return None
+
         # Apply changes and collect series IDs to search
         search_series_ids = set()
-
-        # Apply quality changes
-        quality_search_ids = manager.change_quality(quality_changes)
-        search_series_ids.update(quality_search_ids)
-
-        # Apply monitoring changes
-        monitor_search_ids = manager.change_monitoring(monitorable_items, True)
-        search_series_ids.update(monitor_search_ids)
-        manager.change_monitoring(unmonitorable_items, False)
-
-        # Apply episode monitoring changes
-        episode_search_ids = manager.change_monitoring_episodes(monitor_episodes, True)
-        search_series_ids.update(episode_search_ids)
-        manager.change_monitoring_episodes(unmonitor_episodes, False)
-
-        # Delete unmonitored files if enabled
-        if config.SONARR.delete_unmonitored_files:
-            delete_unmonitored_files()
+        search_state = load_worker_state("sonarr.search_history", {})
+        search_history = {
+            int(series_id): search_times
+            for series_id, search_times in search_state.get("searches", {}).items()
+        }
+        monitored_episodes_history = {
+            int(series_id): changed
+            for series_id, changed in search_state.get("monitoring_changes", {}).items()
+        }
+
+        with run_phase("apply_edits"):
+            # Apply quality changes
+            quality_search_ids = manager.change_quality(quality_changes)
+            search_series_ids.update(quality_search_ids)
+
+            # Apply monitoring changes
+            monitor_search_ids = manager.change_monitoring(monitorable_items, True)
+            search_series_ids.update(monitor_search_ids)
+            manager.change_monitoring(unmonitorable_items, False)
+
+            # Apply episode monitoring changes
+            episode_search_ids = manager.change_monitoring_episodes(
+                monitor_episodes, True
+            )
+            search_series_ids.update(episode_search_ids)
+            manager.change_monitoring_episodes(unmonitor_episodes, False)
+
+            # Delete unmonitored files if enabled
+            if config.SONARR.delete_unmonitored_files and not targeted:
+                delete_unmonitored_files()
+
+            # The next run fetches the edited series again instead of waiting for a full sync,
+            # series whose monitoring already was as wanted keep their mirrored copy
+            invalidate_arr_items(
+                "sonarr",
+                [change["item"]["id"] for change in quality_changes]
+                + list(manager.edited_series),
+            )
 
         # Add recheck releases to search IDs
         search_series_ids.update(recheck_releases)
 
         # Perform searches with cooldown
-        manager.search_series_with_cooldown(search_series_ids)
+        with run_phase("search"):
+            manager.search_series_with_cooldown(search_series_ids)
+            # Older changes can not override a cooldown of a search that is still kept
+            min_time = time.time() - SEARCH_COOLDOWN
+            save_worker_state(
+                "sonarr.search_history",
+                {
+                    "searches": {
+                        series_id: search_times
+                        for series_id, search_times in search_history.items()
+                        if search_times and search_times[-1] >= min_time
+                    },
+                    "monitoring_changes": {
+                        series_id: changed
+                        for series_id, changed in monitored_episodes_history.items()
+                        if changed >= min_time
+                    },
+                },
+            )
 
         print("Ran the Sonarr instance")
-        return None
+        print(f"Media server connections: {media_server.get_connection_stats()}")
+        # Lets the scheduler back off while nothing changes
+        return {
+            "changes": len(quality_changes)
+            + len(monitorable_items)
+            + len(unmonitorable_items)
+            + sum(1 for episode in monitor_episodes if not episode["monitored"])
+            + sum(1 for episode in unmonitor_episodes if episode["monitored"])
+        }
 
     except Exception as error_message:
         pattern_length_difference = r"pyarr\.exceptions\.PyarrServerError: Internal Server Error: Expected query to return (\d+) rows but returned (\d+)"
@@ -22,6 +22,7 @@ media_server = MediaServerinteracter(
     config.MEDIASERVER.media_server_type,
     config.MEDIASERVER.media_server_base_url,
     config.MEDIASERVER.media_server_api_key,
+    config.MEDIASERVER.max_concurrent_requests,
 )
 
 
@@ -176,7 +177,7 @@ def main():
         if playlist["type"] in ["audio", "both"]:
             if not media_server_audio_tracks_by_title:
                 media_server_audio_tracks_by_title = index_tracks_by_title(
-                    media_server.get_music_items()
+                    media_server.iter_music_items()
                 )
             process_playlist_audio(
                 playlist_tracks,
@@ -187,7 +188,7 @@ def main():
         if playlist["type"] in ["video", "both"]:
             if not media_server_video_tracks_by_title:
                 media_server_video_tracks_by_title = index_tracks_by_title(
-                    media_server.get_music_video_items()
+                    media_server.iter_music_video_items()
                 )
             process_playlist_video(
                 playlist_tracks,
@@ -208,6 +209,7 @@ def run():
         config.MEDIASERVER.media_server_type,
         config.MEDIASERVER.media_server_base_url,
         config.MEDIASERVER.media_server_api_key,
+        config.MEDIASERVER.max_concurrent_requests,
     )
 
     main()
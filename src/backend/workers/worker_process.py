@@ -0,0 +1,28 @@
+"""
+Runs one worker in a process of its own, started by the WorkerManager as
+python -m workers.worker_process <worker module> <result file descriptor>
+with the options as JSON on stdin. Only the worker module is imported, not the app.
+"""
+
+import json
+import os
+import sys
+from importlib import import_module
+
+from utils.run_history import set_current_run
+from utils.worker_lease import set_current_lease
+
+
+def main(name: str, result_fd: int):
+    options = json.load(sys.stdin)
+    set_current_run(options["run_id"])
+    set_current_lease(name, options["lease_owner"], options["lease_token"])
+    script_module = import_module(name)
+    result = script_module.run(**(options["kwargs"] or {}))
+    # Results are handed to the stages after this worker, keep them small
+    with os.fdopen(result_fd, "w") as result_file:
+        json.dump(result if isinstance(result, dict) else None, result_file)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]))
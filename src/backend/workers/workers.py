@@ -1,53 +1,325 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from importlib import import_module
 
 import yaml
 
+from utils.log_manager import LoggingManager
+from utils.run_history import finish_run, start_run
+from utils.worker_lease import (
+    acquire_lease,
+    forward_run,
+    release_lease,
+    renew_lease,
+    replica_id,
+    take_forwarded_runs,
+)
+
+logging_manager = LoggingManager()
+
+# The manager running the workers of this process, used to queue runs from the API
+running_manager = None
+
+# Queue entry kwargs marking a run that takes the events queued for the worker
+_EVENT_RUN = object()
+# Queue entry kwargs marking a run that takes the deferred runs of the worker
+_DEFERRED_RUN = object()
+
+
+def _combine_run_kwargs(first, second):
+    """
+    Combines the kwargs of two triggered runs of a worker, values of the later run win.
+    Target lists are merged, unless one of the runs was not targeted as it covers all items.
+    """
+    combined = {**first, **second}
+    targeted = [
+        any(isinstance(value, list) for value in kwargs.values())
+        for kwargs in (first, second)
+    ]
+    for key, value in combined.items():
+        if not isinstance(value, list):
+            continue
+        if not all(targeted):
+            combined[key] = None
+        else:
+            # Targets are JSON values, not all of them hashable
+            combined[key] = list(
+                {
+                    json.dumps(target, sort_keys=True): target
+                    for target in (first.get(key) or []) + (second.get(key) or [])
+                }.values()
+            )
+    return {key: value for key, value in combined.items() if value is not None}
+
 
 class Worker:
-    def __init__(self, name, schedule, max_runtime, max_instances):
+    def __init__(self, name, schedule, max_runtime, max_instances, lease_ttl=60):
         self.name = name
         self.schedule = schedule
         self.max_runtime = max_runtime
         self.max_instances = max_instances
+        # Seconds the lease stays valid without a heartbeat, None to run without a lease
+        self.lease_ttl = lease_ttl
+        # Fencing token while this replica holds the lease of the worker
+        self.lease_token = None
         self.last_run = None
+        self.last_lateness = None
         self.running = False
         self.instances = 0
+        self._instances_lock = threading.Lock()
 
-    def run(self):
-        current_time = datetime.now()
-        if self.schedule["type"] == "startup":
-            if self.last_run is None:
-                self.execute_worker()
-            return  # Exit after one run if it's a startup type
+        # Adaptive interval, backs off up to max_interval while runs produce no changes
+        self.current_interval = schedule.get("interval")
+        self.changed_this_cycle = None
+        # Bumped when the worker is rescheduled, queued runs of older generations are skipped
+        self.generation = 0
+
+    def get_next_run_time(self):
+        """Returns the datetime the worker should run next, None if it should not run again."""
+        if self.schedule["type"] == "stage":
+            return None  # Only runs when the worker it comes after finished
+        elif self.schedule["type"] == "startup":
+            return datetime.now() if self.last_run is None else None
         elif self.schedule["type"] == "interval":
-            next_run_time = (
-                self.last_run + timedelta(minutes=self.schedule["interval"])
-                if self.last_run
-                else None
+            if self.last_run is None:
+                return datetime.now()
+            return self.last_run + timedelta(minutes=self.current_interval)
+        return None
+
+    def record_changes(self, changes):
+        """Stores if a run of this cycle changed something, returns True if the interval got reset."""
+        if self.schedule.get("max_interval") is None:
+            return False
+
+        if changes > 0:
+            self.changed_this_cycle = True
+            if self.current_interval != self.schedule["interval"]:
+                self.current_interval = self.schedule["interval"]
+                return True
+        elif self.changed_this_cycle is None:
+            self.changed_this_cycle = False
+        return False
+
+    def update_interval(self):
+        """Backs off when the last cycle did not change anything, goes back to the base interval when it did."""
+        max_interval = self.schedule.get("max_interval")
+        if max_interval is None:
+            return
+
+        if self.changed_this_cycle is False:
+            self.current_interval = min(
+                self.current_interval * self.schedule.get("backoff", 2), max_interval
             )
-            if self.last_run is None or current_time >= next_run_time:
-                self.execute_worker()
+        elif self.changed_this_cycle:
+            self.current_interval = self.schedule["interval"]
+        self.changed_this_cycle = None
 
-    def execute_worker(self):
-        if self.instances < self.max_instances:
-            print(f"Running {self.name} worker...")
+    def run(self, deadline=None, kwargs=None):
+        current_time = datetime.now()
+        next_run_time = self.get_next_run_time() or deadline
+        if next_run_time is None:
+            return
+        # The scheduler already waited for the deadline, only check when called directly
+        if deadline is None and current_time < next_run_time:
+            return
+
+        # How late the run started compared to when it was due
+        self.last_lateness = (
+            current_time - (deadline or next_run_time)
+        ).total_seconds()
+        logging_manager.log(
+            f"{self.name} started {self.last_lateness:.3f}s after its deadline",
+            level=logging.DEBUG,
+            print_message=False,
+        )
+        return self.execute_worker(kwargs)
+
+    def execute_worker(self, kwargs=None):
+        with self._instances_lock:
+            if self.instances >= self.max_instances:
+                print(f"Maximum instances reached for {self.name}.")
+                return None
+            self.instances += 1
+
+        result = None
+
+        try:
             self.last_run = datetime.now()
+            if self.lease_ttl is not None:
+                # Only one replica sharing the database runs the worker, the lease is kept
+                # between runs and only taken over once the owner stopped its heartbeats
+                self.lease_token = acquire_lease(self.name, self.lease_ttl)
+                if self.lease_token is None:
+                    if kwargs is not None:
+                        # Events and stages can reach any replica, the owner picks them up
+                        forward_run(self.name, kwargs)
+                        logging_manager.log(
+                            f"{self.name} is running on another replica, forwarded the triggered run",
+                            level=logging.INFO,
+                            print_message=False,
+                        )
+                        return None
+                    logging_manager.log(
+                        f"{self.name} is running on another replica, skipping",
+                        level=logging.DEBUG,
+                        print_message=False,
+                    )
+                    return None
+
+            print(f"Running {self.name} worker...")
             self.running = True
-            script_module = import_module(f"{self.name}")
-            script_module.run()
-            self.running = False
-        else:
-            print(f"Maximum instances reached for {self.name}.")
+            run_id = start_run(self.name)
+            # Stays failed when starting or reading the process raises, the run is finished anyway
+            outcome = "failed"
+            try:
+                # A fresh interpreter that only imports the worker module, a fork of this
+                # threaded process could inherit held locks
+                read_fd, write_fd = os.pipe()
+                with os.fdopen(read_fd) as result_file:
+                    try:
+                        process = subprocess.Popen(
+                            [
+                                sys.executable,
+                                "-m",
+                                "workers.worker_process",
+                                self.name,
+                                str(write_fd),
+                            ],
+                            stdin=subprocess.PIPE,
+                            pass_fds=(write_fd,),
+                            text=True,
+                        )
+                    finally:
+                        os.close(write_fd)
+                    try:
+                        process.stdin.write(
+                            json.dumps(
+                                {
+                                    "run_id": run_id,
+                                    "lease_owner": replica_id,
+                                    "lease_token": self.lease_token,
+                                    "kwargs": kwargs,
+                                }
+                            )
+                        )
+                        process.stdin.close()
+                        run_outcome = (
+                            self.supervise(process, self.lease_token) or "success"
+                        )
+                    except BaseException:
+                        if process.poll() is None:
+                            self.cancel(process)
+                        raise
+                    if run_outcome == "success" and process.returncode != 0:
+                        logging_manager.log(
+                            f"{self.name} worker exited with code {process.returncode}",
+                            level=logging.ERROR,
+                        )
+                        run_outcome = "failed"
+                    elif run_outcome == "success":
+                        result_data = result_file.read()
+                        result = json.loads(result_data) if result_data else None
+                    outcome = run_outcome
+            finally:
+                finish_run(run_id, outcome)
+        finally:
+            with self._instances_lock:
+                self.instances -= 1
+                self.running = self.instances > 0
+
+        return result
+
+    def supervise(self, process, lease_token=None):
+        """
+        Waits for the worker process, checking the lease kept alive by the manager heartbeat.
+
+        Returns:
+            str: "killed" if the process was stopped for exceeding max_runtime or losing its lease
+        """
+        deadline = (
+            time.monotonic() + self.max_runtime * 60
+            if self.max_runtime is not None
+            else None
+        )
+        check_interval = self.lease_ttl / 3 if lease_token is not None else None
+        while True:
+            timeout = check_interval
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                process.wait(timeout)
+                return None
+            except subprocess.TimeoutExpired:
+                pass
+
+            if deadline is not None and time.monotonic() >= deadline:
+                logging_manager.log(
+                    f"{self.name} exceeded max runtime of {self.max_runtime} minutes, killing it",
+                    level=logging.WARNING,
+                )
+                self.cancel(process)
+                return "killed"
+            if lease_token is not None and self.lease_token != lease_token:
+                logging_manager.log(
+                    f"{self.name} lost its lease to another replica, killing it",
+                    level=logging.WARNING,
+                )
+                self.cancel(process)
+                return "killed"
+
+    def renew_lease(self):
+        """Heartbeat of the lease, returns False if another replica took it over."""
+        lease_token = self.lease_token
+        if lease_token is None:
+            return True
+        if renew_lease(self.name, lease_token, self.lease_ttl):
+            return True
+        self.lease_token = None
+        return False
+
+    def release_lease(self):
+        if self.lease_token is not None:
+            release_lease(self.name, self.lease_token)
+            self.lease_token = None
+
+    @staticmethod
+    def cancel(process, grace_period=10):
+        process.terminate()
+        try:
+            process.wait(grace_period)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
 
 
 class WorkerManager:
     def __init__(self, config_file):
         self.workers = {}
+        self.max_concurrent_workers = None
+        self.lease_ttl = None
         self.load_config(config_file)
 
+        # Min-heap of (deadline, sequence, worker name, kwargs, generation),
+        # the sequence keeps ties stable
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._stopped = False
+        # Targets of events per worker waiting for their run, e.g. {"series_ids": [1, 2]}
+        self._pending_events = {}
+        # Combined kwargs per worker of triggered runs that found the worker busy
+        self._deferred_runs = {}
+
     def load_config(self, config_file):
         with open(config_file, "r") as f:
             config = yaml.safe_load(f)
@@ -58,22 +330,214 @@ class WorkerManager:
                     details["max_runtime"],
                     details["max_instances"],
                 )
+            scheduler = config.get("scheduler") or {}
+            self.lease_ttl = scheduler.get("lease_ttl", 60)
+            for worker in self.workers.values():
+                worker.lease_ttl = self.lease_ttl
+            self.max_concurrent_workers = scheduler.get(
+                "max_concurrent_workers", len(self.workers)
+            )
+            self.event_delay = scheduler.get("event_delay", 30)
 
     def start_workers(self):
+        global running_manager
+        running_manager = self
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, self.max_concurrent_workers),
+            thread_name_prefix="worker",
+        )
         for worker in self.workers.values():
-            if worker.schedule["type"] == "startup":
-                worker_thread = threading.Thread(target=worker.run)
-                worker_thread.start()
-            elif worker.schedule["type"] == "interval":
-                worker_thread = threading.Thread(target=self.run_worker, args=(worker,))
-                worker_thread.start()
-
-    def run_worker(self, worker):
-        while True:
-            worker.run()
-            time.sleep(
-                1
-            )  # Keep this to prevent a tight loop that consumes too much CPU.
+            self.schedule_worker(worker)
+
+        scheduler_thread = threading.Thread(
+            target=self._scheduler_loop, name="worker-scheduler"
+        )
+        scheduler_thread.start()
+        if self.lease_ttl is not None:
+            threading.Thread(
+                target=self._heartbeat_loop, name="worker-lease-heartbeat", daemon=True
+            ).start()
+
+    def stop_workers(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        # Lets another replica take over right away instead of after the lease expired
+        for worker in self.workers.values():
+            if not worker.running:
+                worker.release_lease()
+
+    def schedule_worker(self, worker, next_run_time=None, kwargs=None):
+        next_run_time = next_run_time or worker.get_next_run_time()
+        if next_run_time is None:
+            return
+
+        # Deadlines are kept on the monotonic clock so wall clock jumps do not matter
+        delay = max(0.0, (next_run_time - datetime.now()).total_seconds())
+        with self._condition:
+            if kwargs is None:
+                # Replaces the regular run that is already queued
+                worker.generation += 1
+            heapq.heappush(
+                self._queue,
+                (
+                    time.monotonic() + delay,
+                    next(self._sequence),
+                    worker.name,
+                    kwargs,
+                    worker.generation,
+                ),
+            )
+            self._condition.notify()
+
+    def trigger_worker(self, name, **kwargs):
+        """Queues a run of the worker right away, the kwargs are passed to its run function."""
+        self.schedule_worker(self.workers[name], datetime.now(), kwargs)
+
+    def queue_event(self, name, **targets):
+        """
+        Queues a targeted run of the worker for an event.
+
+        Events arriving within event_delay seconds of each other are combined into one run,
+        the targets are passed as lists to the run function of the worker.
+        """
+        # An event means something changed, so the full sweeps go back to the base interval
+        self.record_changes(self.workers[name], 1)
+
+        with self._condition:
+            pending = self._pending_events.get(name)
+            if pending is None:
+                self._pending_events[name] = targets
+                self.schedule_worker(
+                    self.workers[name],
+                    datetime.now() + timedelta(seconds=self.event_delay),
+                    _EVENT_RUN,
+                )
+            else:
+                self._pending_events[name] = _combine_run_kwargs(pending, targets)
+
+    def defer_run(self, worker, kwargs):
+        """
+        Retries a triggered run after event_delay seconds. All runs deferred meanwhile are
+        combined into that one run, so they do not pile up while a long run is going.
+        """
+        with self._condition:
+            deferred = self._deferred_runs.get(worker.name)
+            if deferred is not None:
+                self._deferred_runs[worker.name] = _combine_run_kwargs(deferred, kwargs)
+                return
+
+            self._deferred_runs[worker.name] = dict(kwargs)
+            self.schedule_worker(
+                worker,
+                datetime.now() + timedelta(seconds=self.event_delay),
+                _DEFERRED_RUN,
+            )
+
+    def get_cycle_start(self, worker):
+        """Returns the worker starting the cycle the worker is a stage of."""
+        while worker.schedule["type"] == "stage":
+            worker = self.workers[worker.schedule["after"]]
+        return worker
+
+    def record_changes(self, worker, changes):
+        cycle_start = self.get_cycle_start(worker)
+        with self._condition:
+            interval_reset = cycle_start.record_changes(changes)
+            if interval_reset and not cycle_start.running:
+                logging_manager.log(
+                    f"Changes found, {cycle_start.name} back to its base interval",
+                    level=logging.DEBUG,
+                    print_message=False,
+                )
+                self.schedule_worker(cycle_start)
+
+    def get_next_stages(self, name):
+        return [
+            worker
+            for worker in self.workers.values()
+            if worker.schedule["type"] == "stage" and worker.schedule["after"] == name
+        ]
+
+    def _scheduler_loop(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                deadline, _, name, kwargs, generation = self._queue[0]
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    # Sleep until the earliest deadline or until a new one is pushed
+                    self._condition.wait(timeout)
+                    continue
+
+                heapq.heappop(self._queue)
+                if kwargs is None and generation != self.workers[name].generation:
+                    continue
+                if kwargs is _EVENT_RUN:
+                    kwargs = self._pending_events.pop(name, {})
+                elif kwargs is _DEFERRED_RUN:
+                    kwargs = self._deferred_runs.pop(name)
+                due_time = datetime.now() - timedelta(
+                    seconds=time.monotonic() - deadline
+                )
+                self._executor.submit(
+                    self.run_worker, self.workers[name], due_time, kwargs
+                )
+
+    def _heartbeat_loop(self):
+        while not self._stopped:
+            for worker in self.workers.values():
+                try:
+                    if not worker.renew_lease():
+                        logging_manager.log(
+                            f"Lease of {worker.name} was taken over by another replica",
+                            level=logging.WARNING,
+                        )
+                    elif worker.lease_token is not None:
+                        for kwargs in take_forwarded_runs(worker.name):
+                            self.defer_run(worker, kwargs)
+                except Exception as error_message:
+                    logging_manager.log(
+                        f"Could not renew lease of {worker.name}: {error_message}",
+                        level=logging.ERROR,
+                    )
+            time.sleep(self.lease_ttl / 3)
+
+    def run_worker(self, worker, deadline=None, kwargs=None):
+        if kwargs is not None and worker.instances >= worker.max_instances:
+            # Wait for the running instance instead of dropping the triggered run
+            self.defer_run(worker, kwargs)
+            return
+
+        try:
+            result = worker.run(deadline, kwargs)
+            if result is not None and "changes" in result:
+                self.record_changes(worker, result.pop("changes"))
+            if result is not None:
+                # Hand the result of this stage to the stages that come after it
+                for next_stage in self.get_next_stages(worker.name):
+                    self.trigger_worker(next_stage.name, **result)
+        except Exception as error_message:
+            logging_manager.log(
+                f"{worker.name} worker failed: {error_message}", level=logging.ERROR
+            )
+            worker.running = False
+            worker.last_run = worker.last_run or datetime.now()
+        finally:
+            # Triggered runs come on top of the regular schedule which is still queued
+            if kwargs is None and worker.schedule["type"] != "stage":
+                with self._condition:
+                    worker.update_interval()
+                    self.schedule_worker(worker)
+            if self._stopped:
+                # stop_workers left the lease to this run, release it now that it is done
+                worker.release_lease()
 
 
 if __name__ == "__main__":
@@ -16,7 +16,8 @@ export const useSettingsStore = defineStore('settings', () => {
   "media_server_type": "emby",
   "media_server_base_url": "http://media_server:8096/",
   "media_server_api_key": "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX",
-  "create_leaving_soon_collections": false
+  "create_leaving_soon_collections": false,
+  "max_concurrent_requests": 4
 });
 
   async function getMediaserverSettings() {
@@ -212,6 +213,8 @@ export const useSettingsStore = defineStore('settings', () => {
     "base_monitoring_amount": 1,
     "delete_unmonitored_files": false,
     "exclude_tags_from_deletion": [],
+    "max_concurrent_requests": 4,
+    "request_timeout": 30,
     "popular_filters": {
       "very_popular": [],
       "popular": [],